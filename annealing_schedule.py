@@ -0,0 +1,67 @@
+import numpy as np
+
+
+# Adaptive simulated annealing schedule, one object shared by the regions of a repair run
+# The perturbation std is tuned every adapt_interval iterations toward target_acceptance and carried over to the next region,
+# the temperature restarts from T for every region and is cooled by alpha
+# A region stops early once all bad states are repaired (stop_when_repaired), or when the energy did not improve by
+# min_improvement over the last window iterations, and after num_iter iterations at the latest
+class AdaptiveAnnealingSchedule:
+
+    def __init__(self, std=0.2, T=0.1, alpha=0.95, num_iter=200, target_acceptance=0.3, adapt_interval=10, adapt_factor=1.5,
+                 min_std=1e-3, max_std=2.0, window=40, min_improvement=1e-4, stop_when_repaired=True):
+        self.std = std
+        self.T0 = T
+        self.alpha = alpha
+        self.num_iter = num_iter
+        self.target_acceptance = target_acceptance
+        self.adapt_interval = adapt_interval
+        self.adapt_factor = adapt_factor
+        self.min_std = min_std
+        self.max_std = max_std
+        self.window = window
+        self.min_improvement = min_improvement
+        self.stop_when_repaired = stop_when_repaired
+        self.start(-np.inf)
+
+    # Reset the per-region state, obj_value is the energy of the network before annealing
+    def start(self, obj_value):
+        self.T = self.T0
+        self.iteration = 0
+        self.num_accepted = 0
+        self.interval_accepted = 0
+        self.best_obj_values = [obj_value]
+        self.stop_reason = None
+
+    # Record one annealing iteration, obj_value is the current energy and repaired is True if all bad states are safe
+    def update(self, accepted, obj_value, repaired=False):
+        self.iteration += 1
+        self.num_accepted += accepted
+        self.interval_accepted += accepted
+        self.best_obj_values.append(max(self.best_obj_values[-1], obj_value))
+
+        # Cooling
+        self.T *= self.alpha
+
+        # Larger perturbations if too many proposals are accepted, smaller ones if too few
+        if self.iteration % self.adapt_interval == 0:
+            acceptance = self.interval_accepted / self.adapt_interval
+            if acceptance > self.target_acceptance:
+                self.std = min(self.std * self.adapt_factor, self.max_std)
+            elif acceptance < self.target_acceptance:
+                self.std = max(self.std / self.adapt_factor, self.min_std)
+            self.interval_accepted = 0
+
+        if self.stop_when_repaired and repaired:
+            self.stop_reason = 'repaired'
+        elif self.iteration >= self.window and self.best_obj_values[-1] - self.best_obj_values[-1 - self.window] < self.min_improvement:
+            self.stop_reason = 'plateau'
+        elif self.iteration >= self.num_iter:
+            self.stop_reason = 'num_iter'
+
+    def done(self):
+        return self.stop_reason is not None
+
+    def __repr__(self):
+        return (f'AdaptiveAnnealingSchedule(std={self.std:.4g}, T={self.T:.4g}, iteration={self.iteration}, '
+                f'accepted={self.num_accepted}, stop_reason={self.stop_reason})')
@@ -0,0 +1,165 @@
+from incremental_repair_utils import *
+
+
+# Cell sizes of the deduplication grid per benchmark, 1% of the widths of the full (y, h) / (pos, vel) partition regions
+# of generate_partition.py: UUV 0.1 x 1.0 degree, MC 0.01 x 0.01
+GOOD_STATE_RESOLUTION = {'uuv': (0.001, 0.01), 'mc': (0.0001, 0.0001)}
+
+
+# Good states to be protected, as an (N, 2) array with per-state statistics, checked most fragile first
+# margin is the latest robustness of the state under an accepted network, violation_score counts its recent violations
+# under checked networks (decayed per check)
+# States are deduplicated on a grid of resolution cells, a dict from cell to row is the spatial index,
+# and beyond max_size the store is compacted, keeping the min_per_region most fragile states of each region
+# and then the most fragile states overall, so it exceeds max_size if the regions need more states
+class GoodStateStore:
+
+    def __init__(self, benchmark='uuv', states=None, margins=None, regions=None, violation_decay=0.9, resolution=None,
+                 max_size=None, min_per_region=1):
+        self.benchmark = benchmark
+        self.violation_decay = violation_decay
+        self.resolution = np.asarray(GOOD_STATE_RESOLUTION[benchmark] if resolution is None else resolution, dtype=np.float64)
+        self.max_size = max_size
+        self.min_per_region = min_per_region
+        self.states = np.zeros((0, 2))
+        self.margins = np.zeros(0)
+        self.violation_scores = np.zeros(0)
+        self.regions = np.zeros(0, dtype=np.int64)
+        self.index = {}
+        self.num_checks = 0
+        self.last_num_simulated = 0
+        self.num_merged = 0
+        self.num_dropped = 0
+        self._pending_margins = None  # fingerprint of the last checked network, rows and their margins under it
+        if states is not None:
+            self.add(states, margins, regions)
+
+    def _cells(self, states):
+        return np.floor(states / self.resolution).astype(np.int64)
+
+    # Add states (N, k), the first two columns are the state, with their robustness as margins (inf if unknown)
+    # and their region ids, one for all or -1 if unknown
+    # A state in the cell of a stored one is merged into it, keeping the lower margin
+    def add(self, states, margins=None, regions=None):
+        states = states_to_array(states)[:, :2]
+        margins = np.full(len(states), np.inf) if margins is None else np.asarray(margins, dtype=np.float64).reshape(-1)
+        regions = np.broadcast_to(np.asarray(-1 if regions is None else regions, dtype=np.int64), (len(states),))
+        if len(states) == 0:
+            return
+
+        # Merge the duplicates within the batch, first state of a cell represents it
+        cells, first, inverse = np.unique(self._cells(states), axis=0, return_index=True, return_inverse=True)
+        cell_margins = np.full(len(cells), np.inf)
+        np.minimum.at(cell_margins, inverse.reshape(-1), margins)
+        self.num_merged += len(states) - len(cells)
+
+        new_rows = []
+        for i, cell in enumerate(map(tuple, cells.tolist())):
+            row = self.index.get(cell)
+            if row is None:
+                self.index[cell] = len(self.states) + len(new_rows)
+                new_rows.append(i)
+            else:
+                self.margins[row] = min(self.margins[row], cell_margins[i])
+                self.num_merged += 1
+        new_rows = np.array(new_rows, dtype=np.int64)
+        self.states = np.concatenate([self.states, states[first[new_rows]]])
+        self.margins = np.concatenate([self.margins, cell_margins[new_rows]])
+        self.violation_scores = np.concatenate([self.violation_scores, np.zeros(len(new_rows))])
+        self.regions = np.concatenate([self.regions, regions[first[new_rows]]])
+
+        if self.max_size is not None and len(self) > self.max_size:
+            self.compact(self.max_size)
+
+    # Keep the min_per_region most fragile states of each region, then the most fragile others up to max_size states
+    # Region coverage takes precedence, with more regions than max_size allows the store keeps more states and warns
+    def compact(self, max_size):
+        order = self.fragility_order()
+        regions = self.regions[order]
+        by_region = np.argsort(regions, kind='stable')
+        sorted_regions = regions[by_region]
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[by_region] = np.arange(len(order)) - np.searchsorted(sorted_regions, sorted_regions)  # fragility rank within region
+        coverage = rank < self.min_per_region
+        keep = order[coverage]
+        if len(keep) > max_size:
+            print(f'Warning: good state store keeps {len(keep)} states to cover every region, above max_size {max_size}')
+        keep = np.sort(np.concatenate([keep, order[~coverage][:max(max_size - len(keep), 0)]]))
+
+        self.num_dropped += len(self) - len(keep)
+        self._pending_margins = None  # rows move
+        self.states = self.states[keep]
+        self.margins = self.margins[keep]
+        self.violation_scores = self.violation_scores[keep]
+        self.regions = self.regions[keep]
+        self.index = {cell: row for row, cell in enumerate(map(tuple, self._cells(self.states).tolist()))}
+
+    # Indices from the most fragile state: recently violated first, then lowest margin
+    def fragility_order(self):
+        return np.lexsort((self.margins, -self.violation_scores))
+
+    def _simulate(self, net, states, cache, decision=False):
+        if self.benchmark == 'uuv':
+            return uuv_simulate_batch(net, ys=states[:, 0], hs=states[:, 1], decision=decision, cache=cache)
+        elif self.benchmark == 'mc':
+            return mc_simulate_batch(net, pos_0=states[:, 0], vel_0=states[:, 1], decision=decision, cache=cache)
+        else:
+            raise NotImplementedError
+
+    # True if all good states are safe under net, simulated in fragility order in batches doubling from chunk_size,
+    # stops at the first batch with a violation and raises the violation scores of its violated states
+    # The first num_exact states get their robustness as pending margins, the others are only decided, which is cheaper
+    # Pending margins only replace the margins once accept(net) is called, checked networks are mostly rejected candidates
+    # and the fragility order follows the accepted network; for the same reason nothing is cached by default
+    def all_safe(self, net, chunk_size=32, num_exact=32, cache: RobustnessCache = None):
+        self.num_checks += 1
+        self.violation_scores *= self.violation_decay
+        order = self.fragility_order()
+        rows, margins = [], []
+        start = 0
+        safe = True
+        while start < len(order):
+            indices = order[start:start + chunk_size]
+            if start < num_exact:
+                robustness = self._simulate(net, self.states[indices], cache)
+                violated = robustness < 0
+                rows.append(indices)
+                margins.append(robustness)
+            else:
+                violated = ~self._simulate(net, self.states[indices], cache, decision=True)
+                rows.append(indices[violated])
+                margins.append(np.minimum(self.margins[indices[violated]], 0.0))
+            start += len(indices)
+            chunk_size *= 2
+            if violated.any():
+                self.violation_scores[indices[violated]] += 1
+                safe = False
+                break
+        self.last_num_simulated = start
+        self._pending_margins = (as_numpy_control_nn(net).fingerprint(), np.concatenate(rows or [np.zeros(0, dtype=np.int64)]),
+                                 np.concatenate(margins or [np.zeros(0)]))
+        return safe
+
+    # Net is the accepted version, the margins of the last check become the margins if it was of net
+    def accept(self, net):
+        if self._pending_margins is None:
+            return
+        fingerprint, rows, margins = self._pending_margins
+        if fingerprint == as_numpy_control_nn(net).fingerprint():
+            self.margins[rows] = margins
+        self._pending_margins = None
+
+    # States in fragility order, also as np.array(store), so that chunked checks by other simulators meet fragile states first
+    def ordered_states(self):
+        return self.states[self.fragility_order()]
+
+    def __array__(self, dtype=None, copy=None):
+        states = self.ordered_states()
+        return states if dtype is None else states.astype(dtype)
+
+    def __len__(self):
+        return len(self.states)
+
+    def __repr__(self):
+        return (f'GoodStateStore(benchmark={self.benchmark}, states={len(self)}, max_size={self.max_size}, merged={self.num_merged}, '
+                f'dropped={self.num_dropped}, checks={self.num_checks}, last_simulated={self.last_num_simulated})')
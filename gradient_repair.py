@@ -0,0 +1,98 @@
+import time
+from network_snapshot import *
+
+
+# Differentiable robustness of states (N, 2) under a torch module, smoothed by temperature
+def robustness_torch(net: nn.Module, states, benchmark='uuv', temperature=0.0):
+    if benchmark == 'uuv':
+        return uuv_simulate_torch(net, states[:, 0], states[:, 1], temperature=temperature)
+    elif benchmark == 'mc':
+        return mc_simulate_torch(net, states[:, 0], states[:, 1], temperature=temperature)
+    else:
+        raise NotImplementedError
+
+
+# Smoothed bad states energy (mean robustness) of a version and its gradient with respect to the flat parameters
+def energy_gradient(net: NetworkSnapshot, bad_states, temperature=0.0):
+    network = net.to_module()
+    energy = torch.mean(robustness_torch(network, states_to_array(bad_states), net.benchmark, temperature))
+    energy.backward()
+    gradient = torch.nn.utils.parameters_to_vector(param.grad for param in network.parameters())
+    return energy.item(), gradient.numpy()
+
+
+# Gradients of the robustness of each state with respect to the flat parameters, (N, num_params)
+def robustness_jacobian(net: NetworkSnapshot, states, temperature=0.0):
+    network = net.to_module()
+    robustness = robustness_torch(network, states_to_array(states), net.benchmark, temperature)
+    jacobian = []
+    for i in range(len(robustness)):
+        gradients = torch.autograd.grad(robustness[i], list(network.parameters()), retain_graph=True, allow_unused=True)
+        jacobian.append(torch.cat([torch.zeros(param.numel()) if gradient is None else gradient.reshape(-1)
+                                   for param, gradient in zip(network.parameters(), gradients)]).numpy())
+    return np.stack(jacobian)
+
+
+# Gradient repair subroutine, drop-in alternative to simulated_annealing
+# Maximizes the barriered energy of the bad and good states with Adam or L-BFGS on the smoothed robustness,
+# each step is scored by the exact barriered energy and the best version is returned with it
+# Step versions are scored without the robustness cache, they are never revisited
+# Stops once all bad and good states are safe
+def gradient_repair(region_id, net, bad_states, good_states, lambda_=1.0, optimizer='adam', lr=1e-3, num_iter=100,
+                    temperature=0.01, benchmark='uuv'):
+
+    start_time = time.time()
+
+    print(f'Gradient repair on region {region_id} with {optimizer} ...')
+
+    if benchmark == 'uuv':
+        barriered_energy = uuv_barriered_energy
+    elif benchmark == 'mc':
+        barriered_energy = mc_barriered_energy
+    else:
+        raise NotImplementedError
+
+    net = net if isinstance(net, NetworkSnapshot) else NetworkSnapshot.from_module(net)
+    bad_states = states_to_array(bad_states)
+    good_states = states_to_array(good_states)
+    network = net.to_module()
+
+    if optimizer == 'adam':
+        torch_optimizer = torch.optim.Adam(network.parameters(), lr=lr)
+    elif optimizer == 'lbfgs':
+        torch_optimizer = torch.optim.LBFGS(network.parameters(), lr=lr, max_iter=5, line_search_fn='strong_wolfe')
+    else:
+        raise NotImplementedError
+
+    num_evaluations = 0
+
+    def closure():
+        nonlocal num_evaluations
+        num_evaluations += 1
+        torch_optimizer.zero_grad()
+        loss = -lambda_ * torch.mean(robustness_torch(network, bad_states, benchmark, temperature))
+        if len(good_states) > 0:
+            loss = loss - torch.mean(robustness_log_barriers_torch(robustness_torch(network, good_states, benchmark, temperature)))
+        loss.backward()
+        return loss
+
+    best_net = net
+    best_obj_value, _, _ = barriered_energy(bad_states, good_states, net, lambda_=lambda_)
+    num_exact_evaluations = 1
+    for i in range(num_iter):
+        torch_optimizer.step(closure)
+
+        new_net = best_net.with_params(torch.nn.utils.parameters_to_vector(network.parameters()).detach().numpy())
+        new_obj_value, h_robustness_bad, h_robustness_good = barriered_energy(bad_states, good_states, new_net, lambda_=lambda_, cache=None)
+        num_exact_evaluations += 1
+        print(f'Gradient step {i}: barriered energy {new_obj_value}')
+        if new_obj_value > best_obj_value:
+            best_net, best_obj_value = new_net, new_obj_value
+            if (h_robustness_bad >= 0).all() and (h_robustness_good >= 0).all():
+                print('All bad and good states safe, stop')
+                break
+
+    print(f'Objective evaluations: {num_evaluations} gradient, {num_exact_evaluations} exact')
+    print(f'Execution time: {time.time() - start_time}')
+
+    return best_net, best_obj_value
@@ -1,23 +1,37 @@
 import numpy as np
 import time
-from incremental_repair_utils import *
-
-
-def uuv_control_nn_convex_comb(net_1: UUV_Control_NN, net_2: UUV_Control_NN, w=0.5):
-    assert 0.0 <= w <= 1.0
-    net_comb = UUV_Control_NN()
-    for param1, param2, param_avg in zip(net_1.parameters(), net_2.parameters(), net_comb.parameters()):
-        param_avg.data.copy_(param1.data * w + param2.data * (1 - w))
-    return net_comb
-
-
-# net_lo: old network before sim annealing, net_hi: new network after sim annealing
-def uuv_ibcl_convex_comb_binary_search(net_lo: UUV_Control_NN, net_hi: UUV_Control_NN, bad_states: list, good_states: list, epsilon_step=1e-7):
+from network_snapshot import *
+from good_state_store import GoodStateStore
+
+
+# net_lo: old network before sim annealing, net_hi: new network after sim annealing, torch modules or versions of any benchmark
+# w is the weight of net_lo, each step moves the endpoint on its side to the tested combination and then tests w_mid between the
+# new endpoints, all combinations are evaluated on one ParameterInterpolation of the original endpoints
+# Returns the last tested version and whether it keeps all good states safe and repairs a bad state
+# Tested combinations are never revisited, so they are simulated without a cache by default
+def ibcl_convex_comb_binary_search(net_lo, net_hi, bad_states: list, good_states: list, benchmark='uuv', epsilon_step=1e-7,
+                                   cache: RobustnessCache = None):
+
+    if benchmark == 'uuv':
+        all_safe, any_safe = uuv_all_safe, uuv_any_safe
+    elif benchmark == 'mc':
+        all_safe, any_safe = mc_all_safe, mc_any_safe
+    else:
+        raise NotImplementedError
+
+    bad_states = states_to_array(bad_states)
+    good_state_store = good_states if isinstance(good_states, GoodStateStore) else None
+    good_states = states_to_array(good_states)
+    net_lo = net_lo if isinstance(net_lo, NetworkSnapshot) else NetworkSnapshot.from_module(net_lo)
+    net_hi = net_hi if isinstance(net_hi, NetworkSnapshot) else NetworkSnapshot.from_module(net_hi)
+    interpolation = ParameterInterpolation(net_lo, net_hi)
 
     w_lo = 0.0
     w_hi = 1.0
     w_mid = 0.5
-    net_mid = net_hi  # init to new network
+    e_lo = 1.0  # weights of the original net_lo in the current endpoints
+    e_hi = 0.0
+    e_mid = e_hi  # init to new network
     success = False
 
     start_time = time.time()
@@ -27,35 +41,25 @@ def uuv_ibcl_convex_comb_binary_search(net_lo: UUV_Control_NN, net_hi: UUV_Contr
         print(f'IBCL convex comb binary search with w_mid = {w_mid} ...')
 
         # Convex combination in Gaussian space - equivalent to NN weights
-        net_mid = uuv_control_nn_convex_comb(net_lo, net_hi, w=w_mid)
-
-        # Check if any good state is broken
-        h_robustness_good = []
-        for good_state in good_states:
-            _, traj_y_good = uuv_simulate(net=net_mid, init_pos_y=good_state[0],
-                                      init_global_heading_deg=good_state[1])
-            h_robustness_good += [uuv_robustness(traj_y_good)]
+        e_mid = w_mid * e_lo + (1 - w_mid) * e_hi
+        net_mid = interpolation.network_at(e_mid)
 
-        # if len(h_robustness_good) > 0:
-        #     print(f'Good states robustness after comb, min: {np.min(h_robustness_good)}')
+        # Check if any good state is broken, stops at the first broken one
+        if good_state_store is not None:
+            good_states_safe = good_state_store.all_safe(net_mid, cache=cache)
+        else:
+            good_states_safe = all_safe(net_mid, good_states[:, 0], good_states[:, 1], cache=cache)
 
-        if len(h_robustness_good) == 0 or np.min(h_robustness_good) < 0.0:  # Good state broken, step closer to old network
+        if len(good_states) == 0 or not good_states_safe:  # Good state broken, step closer to old network
             w_hi = w_mid
             w_mid = (w_lo + w_hi) / 2
-            net_hi = net_mid
+            e_hi = e_mid
             continue
 
         # No good state is broken, check if any bad state is repaired
-        h_robustness_bad = []
-        for bad_state in bad_states:
-            _, traj_y_bad = uuv_simulate(net=net_mid, init_pos_y=bad_state[0],
-                                          init_global_heading_deg=bad_state[1])
-            h_robustness_bad += [uuv_robustness(traj_y_bad)]
+        bad_state_repaired = any_safe(net_mid, bad_states[:, 0], bad_states[:, 1], cache=cache)
 
-        # if len(h_robustness_bad) > 0:
-        #     print(f'Bad states robustness after comb, min: {np.min(h_robustness_bad)}')
-
-        if len(h_robustness_bad) == 0 or np.max(h_robustness_bad) >= 0.0:  # No good state is broken and a bad state repaired, succeed
+        if len(bad_states) == 0 or bad_state_repaired:  # No good state is broken and a bad state repaired, succeed
             print('Success')
             success = True
             break
@@ -63,73 +67,89 @@ def uuv_ibcl_convex_comb_binary_search(net_lo: UUV_Control_NN, net_hi: UUV_Contr
         # No good state is broken and bad region is not repaired, step closer to new network
         w_lo = w_mid
         w_mid = (w_lo + w_hi) / 2
-        net_lo = net_mid
+        e_lo = e_mid
 
     print(f'Computing IBCL convex comb takes {time.time() - start_time}')
 
-    return net_mid, success
+    return interpolation.snapshot_at(e_mid), success
 
 
-def mc_control_nn_convex_comb(net_1: MC_Control_NN, net_2: MC_Control_NN, w=0.5):
-    assert 0.0 <= w <= 1.0
-    net_comb = MC_Control_NN()
-    for param1, param2, param_avg in zip(net_1.parameters(), net_2.parameters(), net_comb.parameters()):
-        param_avg.data.copy_(param1.data * w + param2.data * (1 - w))
-    return net_comb
-
-
-# net_lo: old network before sim annealing, net_hi: new network after sim annealing
-def mc_ibcl_convex_comb_binary_search(net_lo: MC_Control_NN, net_hi: MC_Control_NN, bad_states: list, good_states: list, epsilon_step=1e-7):
+# Robustness (K, N) of K networks on N states, simulated in chunks of chunk_size in one population batch per chunk
+# Networks are dropped from the later chunks once a state is violated, their robustness is nan there
+def population_robustness_until_violation(simulate_population, nets: list, states, chunk_size=256):
+    robustness = np.full((len(nets), len(states)), np.nan)
+    rows = np.arange(len(nets))
+    for chunk in state_chunks(len(states), chunk_size):
+        if len(rows) == 0:
+            break
+        robustness[rows, chunk] = simulate_population([nets[k] for k in rows], states[chunk, 0], states[chunk, 1])
+        rows = rows[(robustness[rows, chunk] >= 0).all(axis=1)]
+    return robustness
+
+
+# Interpolation weights w of net_lo (old network) against 1 - w of net_hi (new network), refined k-ary instead of binary
+# Each round simulates num_points evenly spaced weights of [w_lo, w_hi] together, on the good states until their first
+# violation and on the bad states, with the same acceptance as the binary search: all good states safe and any bad state repaired
+# Without an acceptable weight, the next round refines between the last weight breaking a good state and the first keeping
+# all safe, until the good states robustness there is below robustness_tol or the weights differ by less than epsilon_step
+def ibcl_convex_comb_grid_search(net_lo, net_hi, bad_states: list, good_states: list, benchmark='uuv', num_points=8, robustness_tol=1e-3,
+                                 epsilon_step=1e-7, max_rounds=10):
+
+    if benchmark == 'uuv':
+        simulate_population = uuv_simulate_population
+    elif benchmark == 'mc':
+        simulate_population = mc_simulate_population
+    else:
+        raise NotImplementedError
+
+    bad_states = states_to_array(bad_states)
+    good_states = states_to_array(good_states)
+    net_lo = net_lo if isinstance(net_lo, NetworkSnapshot) else NetworkSnapshot.from_module(net_lo)
+    net_hi = net_hi if isinstance(net_hi, NetworkSnapshot) else NetworkSnapshot.from_module(net_hi)
+    interpolation = ParameterInterpolation(net_lo, net_hi)
 
     w_lo = 0.0
     w_hi = 1.0
-    w_mid = 0.5
     net_mid = net_hi  # init to new network
     success = False
 
     start_time = time.time()
 
-    while w_hi - w_lo >= epsilon_step:
-
-        print(f'IBCL convex comb binary search with w_mid = {w_mid} ...')
-
-        # Convex combination in Gaussian space - equivalent to NN weights
-        net_mid = mc_control_nn_convex_comb(net_lo, net_hi, w=w_mid)
-
-        # Check if any good state is broken
-        h_robustness_good = []
-        for good_state in good_states:
-            traj_pos_good, _ = mc_simulate(net=net_mid, pos_0=good_state[0], vel_0=good_state[1])
-            h_robustness_good += [mc_robustness(traj_pos_good)]
-
-        # if len(h_robustness_good) > 0:
-        #     print(f'Good states robustness after comb, min: {np.min(h_robustness_good)}')
+    for i in range(max_rounds):
 
-        if len(h_robustness_good) == 0 or np.min(h_robustness_good) < 0.0:  # Good state broken, step closer to old network
-            w_hi = w_mid
-            w_mid = (w_lo + w_hi) / 2
-            net_hi = net_mid
-            continue
+        weights = np.linspace(w_lo, w_hi, num_points)
+        print(f'IBCL convex comb grid search with w in [{w_lo}, {w_hi}] ...')
 
-        # No good state is broken, check if any bad state is repaired
-        h_robustness_bad = []
-        for bad_state in bad_states:
-            traj_pos_bad, _ = mc_simulate(net=net_mid, pos_0=bad_state[0], vel_0=bad_state[1])
-            h_robustness_bad += [mc_robustness(traj_pos_bad)]
+        # Convex combinations in Gaussian space - equivalent to NN weights
+        nets = [net_hi.with_params(params) for params in interpolation.params_at(weights)]
+        h_robustness_good = population_robustness_until_violation(simulate_population, nets, good_states)
+        good_states_safe = (h_robustness_good >= 0).all(axis=1) & (len(good_states) > 0)
+        safe = np.flatnonzero(good_states_safe)
+        if len(safe) == 0:  # Good states broken for every weight
+            break
 
-        # if len(h_robustness_bad) > 0:
-        #     print(f'Bad states robustness after comb, min: {np.min(h_robustness_bad)}')
+        # Bad states only matter where no good state is broken
+        if len(bad_states) == 0:
+            bad_state_repaired = np.ones(len(safe), dtype=bool)
+        else:
+            h_robustness_bad = simulate_population([nets[k] for k in safe], bad_states[:, 0], bad_states[:, 1])
+            bad_state_repaired = (h_robustness_bad >= 0).any(axis=1)
 
-        if len(h_robustness_bad) == 0 or np.max(h_robustness_bad) >= 0.0:  # No good state is broken and a bad state repaired, succeed
+        if bad_state_repaired.any():  # Closest to the new network among the acceptable weights
             print('Success')
+            net_mid = nets[safe[np.argmax(bad_state_repaired)]]
             success = True
             break
 
-        # No good state is broken and bad region is not repaired, step closer to new network
-        w_lo = w_mid
-        w_mid = (w_lo + w_hi) / 2
-        net_lo = net_mid
+        # Refine between the last broken and the first safe weight, unless the good states are at the boundary there
+        j = safe[0]
+        net_mid = nets[j]
+        if j == 0 or np.min(h_robustness_good[j]) < robustness_tol:
+            break
+        w_lo, w_hi = weights[j - 1], weights[j]
+        if w_hi - w_lo < epsilon_step:
+            break
 
     print(f'Computing IBCL convex comb takes {time.time() - start_time}')
 
-    return net_mid, success
\ No newline at end of file
+    return net_mid, success
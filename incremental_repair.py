@@ -1,178 +1,337 @@
 import os
 import argparse
+import inspect
 from ibcl_convex_comb import *
+from network_snapshot import *
+from parallel_annealing import *
+from annealing_schedule import AdaptiveAnnealingSchedule
+from gradient_repair import gradient_repair, energy_gradient, robustness_jacobian
+from good_state_store import GoodStateStore
+from region_queue import RegionQueue
 
 
 # Simulated annealing subroutine
-def simulated_annealing(region_id, net, bad_states, std=0.2, T=0.1, alpha=0.95, num_iter=200, benchmark='uuv'):
+# net is a NetworkSnapshot (or a torch module, snapshotted first), returns the last accepted version and its energy
+# With num_proposals > 1, every iteration draws that many perturbations and evaluates them in one population simulation,
+# then the M-H criterion is applied to the best one (proposal_selection='best'),
+# or to each in draw order until one is accepted (proposal_selection='sequential')
+# With early_reject (single Gaussian proposals), the M-H uniform is drawn first and the bad states are simulated in chunks of
+# early_reject_chunk_size, largest robustness slack under the current version first, until robustness upper bounds
+# show the proposal cannot be accepted
+# With an AdaptiveAnnealingSchedule, std, T, cooling and termination come from the schedule instead of std, T, alpha, num_iter
+# With proposal='langevin' (single proposals), the Gaussian perturbation is centered on a step of langevin_step (std ** 2 / 2
+# by default) along the gradient of the smoothed bad states energy, and the M-H criterion adds the proposal density ratio
+# With a PerturbationSubspace, perturbations (and Langevin steps) stay in that subspace of the parameters
+def simulated_annealing(region_id, net, bad_states, std=0.2, T=0.1, alpha=0.95, num_iter=200, benchmark='uuv',
+                        num_proposals=1, proposal_selection='best', early_reject=False, early_reject_chunk_size=None,
+                        schedule: AdaptiveAnnealingSchedule = None, proposal='gaussian', langevin_step=None, langevin_temperature=0.01,
+                        subspace: PerturbationSubspace = None):
 
     start_time = time.time()
 
     print(f'Simulated annealing on region {region_id} ...')
     # task_name = f'iter_{iter_num}_region_{region_id}'
 
+    if early_reject and (proposal != 'gaussian' or num_proposals > 1):
+        raise NotImplementedError('Early reject supports single Gaussian proposals only')
+    if proposal == 'langevin' and num_proposals > 1:
+        raise ValueError('Langevin proposals are drawn one per iteration, num_proposals must be 1')
+
+    bad_states = states_to_array(bad_states)
     if benchmark == 'uuv':
-        current_obj_value = uuv_energy(bad_states, net)
+        energy, energy_population = uuv_energy, uuv_energy_population
+        simulate_batch, simulate_bounded = uuv_simulate_batch, uuv_simulate_bounded
+        upper_bounds = uuv_robustness_upper_bounds(bad_states[:, 0], bad_states[:, 1])
     elif benchmark == 'mc':
-        current_obj_value = mc_energy(bad_states, net)
+        energy, energy_population = mc_energy, mc_energy_population
+        simulate_batch, simulate_bounded = mc_simulate_batch, mc_simulate_bounded
+        upper_bounds = mc_robustness_upper_bounds(bad_states[:, 0], bad_states[:, 1])
     else:
         raise NotImplementedError
 
+    current_net = net if isinstance(net, NetworkSnapshot) else NetworkSnapshot.from_module(net)
+    if early_reject:
+        current_robustness = simulate_batch(current_net, bad_states[:, 0], bad_states[:, 1], cache=ROBUSTNESS_CACHE)
+        current_obj_value = np.mean(current_robustness)
+        num_evaluated_total = 0
+    else:
+        current_obj_value = energy(bad_states, current_net)
+
+    if schedule is not None:
+        schedule.start(current_obj_value)
+        std, T, num_iter = schedule.std, schedule.T, schedule.num_iter
+        repaired = (simulate_batch(current_net, bad_states[:, 0], bad_states[:, 1], cache=ROBUSTNESS_CACHE) >= 0).all()
+
+    num_accepted = 0
+    gradient_time = 0.0
+    if proposal == 'langevin':
+        t = time.time()
+        _, current_gradient = energy_gradient(current_net, bad_states, temperature=langevin_temperature)
+        current_gradient = current_gradient if subspace is None else subspace.project(current_gradient)
+        gradient_time += time.time() - t
+
+    num_iterations = 0
     for i in range(num_iter):
-        rejected = False
         print(f"Annealing iteration {i} ...")
-        old_params = [param.clone() for param in net.parameters()]
-
-        # Perturb the control network
-        for param in net.parameters():
-            noise = torch.normal(mean=0.0, std=std, size=param.size())
-            param.data += noise
-
-        if benchmark == 'uuv':
-            new_obj_value = uuv_energy(bad_states, net)
-        elif benchmark == 'mc':
-            new_obj_value = mc_energy(bad_states, net)
+        num_iterations += 1
+
+        # Perturb the control network, as new versions
+        if early_reject:
+            new_net = current_net.perturb(std, subspace=subspace)
+
+            # M-H criterion below accepts iff delta_E >= min(0.001, T * log(u))
+            u = torch.rand(1).item()
+            threshold = current_obj_value + min(0.001, T * np.log(u) if u > 0 else -np.inf)
+
+            order = np.argsort(current_robustness - upper_bounds)
+            robustness, simulated = bounded_robustness(lambda states, stop_below: simulate_bounded(new_net, states[:, 0], states[:, 1], stop_below),
+                                                       bad_states[order], upper_bounds[order], threshold, chunk_size=early_reject_chunk_size)
+            num_evaluated = np.count_nonzero(simulated)
+            num_evaluated_total += num_evaluated
+            print(f"Evaluated {num_evaluated} / {len(bad_states)} bad states")
+
+            # Upper bounds below the threshold reject, otherwise robustness is exact
+            rejected = np.mean(robustness) < threshold
+            if not rejected:
+                current_robustness = np.empty_like(robustness)
+                current_robustness[order] = robustness
+                current_net, current_obj_value = new_net, np.mean(current_robustness)
+                ROBUSTNESS_CACHE.store(simulation_cache_key(benchmark), current_net.fingerprint(), bad_states, current_robustness)
         else:
-            raise NotImplementedError
-
-        # Metropolis-Hastings criterion
-        delta_E = new_obj_value - current_obj_value
-        if delta_E < 0.001 and torch.rand(1).item() > np.exp(delta_E / T):
-            print("Rejected due to M-H criterion violated, rollback to previous params")
-            for old_param, param in zip(old_params, net.parameters()):
-                param.data = old_param.data
+            if proposal == 'langevin':
+                step = std ** 2 / 2 if langevin_step is None else langevin_step
+                mean = current_net.params + step * current_gradient
+                if subspace is None:
+                    new_net = current_net.with_params(mean + torch.normal(mean=0.0, std=std, size=mean.shape).numpy())
+                else:
+                    new_net = current_net.with_params(mean + subspace.sample(std))
+                t = time.time()
+                _, new_gradient = energy_gradient(new_net, bad_states, temperature=langevin_temperature)
+                new_gradient = new_gradient if subspace is None else subspace.project(new_gradient)
+                gradient_time += time.time() - t
+                # log q(current | new) - log q(new | current) of the Gaussian proposals
+                reverse_mean = new_net.params + step * new_gradient
+                log_proposal_ratio = (np.sum((new_net.params - mean) ** 2) - np.sum((current_net.params - reverse_mean) ** 2)) / (2 * std ** 2)
+                new_robustness = simulate_batch(new_net, bad_states[:, 0], bad_states[:, 1])
+                candidates = [(new_net, np.mean(new_robustness), log_proposal_ratio, new_robustness)]
+            elif num_proposals == 1:
+                new_net = current_net.perturb(std, subspace=subspace)
+                new_robustness = simulate_batch(new_net, bad_states[:, 0], bad_states[:, 1])
+                candidates = [(new_net, np.mean(new_robustness), 0.0, new_robustness)]
+            else:
+                new_nets = [current_net.perturb(std, subspace=subspace) for _ in range(num_proposals)]
+                new_obj_values = energy_population(bad_states, new_nets)
+                if proposal_selection == 'best':
+                    order = [int(np.argmax(new_obj_values))]
+                elif proposal_selection == 'sequential':
+                    order = range(num_proposals)
+                else:
+                    raise NotImplementedError
+                candidates = [(new_nets[k], new_obj_values[k], 0.0, None) for k in order]
+
+            # Metropolis-Hastings criterion, rollback is keeping the current version
+            # Proposals are simulated without the cache, mostly rejected versions would fill it, only accepted ones are stored
             rejected = True
+            for new_net, new_obj_value, log_proposal_ratio, new_robustness in candidates:
+                delta_E = new_obj_value - current_obj_value
+                if delta_E < 0.001 and torch.rand(1).item() > np.exp(min(delta_E / T + log_proposal_ratio, 0.0)):
+                    continue
+                current_net, current_obj_value = new_net, new_obj_value
+                if new_robustness is not None:
+                    ROBUSTNESS_CACHE.store(simulation_cache_key(benchmark), current_net.fingerprint(), bad_states, new_robustness)
+                if proposal == 'langevin':
+                    current_gradient = new_gradient
+                rejected = False
+                break
 
-        # Not rejected, update params
-        if not rejected:
+        if rejected:
+            print("Rejected due to M-H criterion violated, rollback to previous params")
+        else:
             print("Better params identified")
-            current_obj_value = new_obj_value  # Update current value
+            num_accepted += 1
 
-        # Cooling
-        T *= alpha
+        if schedule is None:
+            # Cooling
+            T *= alpha
+            continue
 
+        if not rejected:
+            if early_reject:
+                repaired = (current_robustness >= 0).all()
+            else:
+                repaired = (simulate_batch(current_net, bad_states[:, 0], bad_states[:, 1], cache=ROBUSTNESS_CACHE) >= 0).all()
+        schedule.update(not rejected, current_obj_value, repaired)
+        if schedule.done():
+            break
+        std, T = schedule.std, schedule.T
+
+    if schedule is not None:
+        print(schedule)
+    if early_reject:
+        print(f'Bad states evaluated per proposal: {num_evaluated_total / max(num_iterations, 1):.1f} / {len(bad_states)}')
+    print(f'Acceptance rate: {num_accepted / max(num_iterations, 1):.3f}')
+    if proposal == 'langevin':
+        print(f'Gradient time per iteration: {gradient_time / max(num_iterations, 1)}')
     print(f'Execution time: {time.time() - start_time}')
 
-    return net
+    return current_net, current_obj_value
+
+
+# Annealing subspace of a region from its spec: 'all', 'last_layer', 'layers:fc2,fc3', 'random:<rank>' or 'pca:<rank>'
+# pca spans the principal directions of the bad states robustness gradients under net
+def perturbation_subspace(spec, net: NetworkSnapshot, bad_states):
+    kind, _, arg = spec.partition(':')
+    if kind == 'all':
+        return None
+    elif kind == 'last_layer':
+        return PerturbationSubspace.last_layer(net.layout)
+    elif kind == 'layers':
+        return PerturbationSubspace.layers(net.layout, arg.split(','))
+    elif kind == 'random':
+        return PerturbationSubspace.random(net.layout, int(arg))
+    elif kind == 'pca':
+        return PerturbationSubspace.pca(net.layout, robustness_jacobian(net, bad_states), int(arg), center=False)
+    else:
+        raise NotImplementedError
 
 
 # Main ISAR algorithm
-def isari_main(verisig_result_path, sampled_result_path, net_path, output_path, benchmark='uuv', small=False):
+# With annealing_chains > 1, each region is annealed by parallel tempering on a pool of annealing_workers processes
+# annealing_options are extra keyword arguments of simulated_annealing, e.g. num_proposals
+# With repair_method='gradient', regions are repaired by gradient_repair instead, gradient_options are its extra keyword arguments
+# subspace is the spec of the parameters perturbed by simulated_annealing, see perturbation_subspace
+# ibcl_search is 'binary' (bisection) or 'grid' (k-ary search in batched simulations) for the IBCL interpolation
+# max_good_states caps the good state store, which is compacted beyond it keeping every region covered
+# With incremental_check, samples of green regions far from the safety boundary are left stale (nan) after a repair,
+# see check_samples, until the final checkpoint sample_checkpoint_final, which has the robustness of all samples
+# checkpoint_format is 'npz' (sample checkpoints as robustness deltas against samples_base.npz, see write_table) or 'csv'
+def isari_main(verisig_result_path, sampled_result_path, net_path, output_path, benchmark='uuv', small=False,
+               annealing_chains=1, swap_interval=20, annealing_workers=None, annealing_options=None, repair_method='annealing',
+               gradient_options=None, subspace='all', ibcl_search='binary', max_good_states=None,
+               incremental_check=False, checkpoint_format='npz'):
+
+    # Parallel tempering and gradient repair do not take the options of simulated_annealing, options at their defaults pass
+    if repair_method not in ('annealing', 'gradient'):
+        raise NotImplementedError(f'Unknown repair method {repair_method}')
+    defaults = inspect.signature(simulated_annealing).parameters
+    unknown_options = [key for key in (annealing_options or {}) if key not in defaults]
+    if unknown_options:
+        raise ValueError(f'Unknown annealing options {unknown_options}, simulated_annealing takes {list(defaults)}')
+    changed_options = [key for key, value in (annealing_options or {}).items() if value != defaults[key].default]
+    if subspace != 'all':
+        changed_options.append('subspace')
+    if repair_method == 'gradient' and annealing_chains > 1:
+        changed_options.append('annealing_chains')
+    if repair_method == 'gradient' and changed_options:
+        raise NotImplementedError(f'Gradient repair does not support the annealing options {changed_options}')
+    if repair_method == 'annealing' and annealing_chains > 1 and changed_options:
+        raise NotImplementedError(f'Parallel tempering does not support the annealing options {changed_options}')
 
     # Directory to save all logs and checkpoints
     if not os.path.exists(output_path):
         os.mkdir(output_path)
 
-    def check_red(region_id):
-        return dict_color[region_id] == 'red'
-
-    def check_yellow(region_id):
-        return dict_color[region_id] == 'yellow'
-
-    def check_green(region_id):
-        return dict_color[region_id] == 'green'
+    # After a repair, requeue the red regions whose samples changed with their new avg robustness, drop the regions no longer red
+    def update_region_queue(df_summary_prev, df_summary):
+        mean_prev, mean = df_summary_prev['mean'].to_numpy(), df_summary['mean'].to_numpy()
+        changed = (mean != mean_prev) & ~(np.isnan(mean) & np.isnan(mean_prev))
+        red = (df_summary['color'] == 'red').to_numpy()
+        region_queue.update(np.flatnonzero(changed & red), mean[changed & red])
+        region_queue.remove(np.flatnonzero(~red))
 
     start_time = time.time()
 
-    dict_color = color_regions(verisig_result_path, sampled_result_path)  # color regions
-    df_sample = pd.read_csv(sampled_result_path)
-    red_mask = df_sample['region'].apply(check_red)
-    df_red = df_sample[red_mask]
-    yellow_mask = df_sample['region'].apply(check_yellow)
-    df_yellow = df_sample[yellow_mask]
-    green_mask = df_sample['region'].apply(check_green)
-    df_green = df_sample[green_mask]
-
-    # Sort the red regions in decreasing avg robustness (greedy order in ease of repair)
-    region_robustness = sort_regions(df_red)
-
-    # Get good states - for computation efficiency, take one good state to be protected per region
-    df_red_good = df_red[df_red['result'] >= 0.0]
-    df_red_good_approx = df_red_good.groupby('region').apply(lambda x: x.head(5)).reset_index(drop=True)
-    df_yellow_approx = df_yellow.groupby('region').apply(lambda x: x.head(5)).reset_index(drop=True)
-    df_green_approx = df_green.groupby('region').apply(lambda x: x.head(5)).reset_index(drop=True)
-    df_good_approx = pd.concat([df_red_good_approx, df_yellow_approx, df_green_approx])
-
     if benchmark == 'uuv':
-        good_states = [(row['y'], row['h'], row['result']) for index, row in df_good_approx.iterrows()]
+        state_columns = ('y', 'h')
     elif benchmark == 'mc':
-        good_states = [(row['pos'], row['vel'], row['result']) for index, row in df_good_approx.iterrows()]
+        state_columns = ('pos', 'vel')
     else:
         raise NotImplementedError
 
-    # Load controller network to be repaired
-    with open(net_path, 'rb') as f:
-        model_dict = yaml.safe_load(f)
-    if benchmark == 'uuv':
-        net = UUV_Control_NN()
-    elif benchmark == 'mc':
-        net = MC_Control_NN()
+    # Sampled states sorted by region, the working copy of the sampled results
+    # All regions of the Verisig results are indexed, also the ones without samples
+    samples = SampleStore.read(sampled_result_path, state_columns, num_regions=len(read_table(verisig_result_path)))
+    if checkpoint_format == 'npz':  # base table of the sample checkpoints
+        sampled_base_path = os.path.join(output_path, 'samples_base.npz')
+        samples.write(sampled_base_path)
+    elif checkpoint_format == 'csv':
+        sampled_base_path = None
     else:
         raise NotImplementedError
-    load_model_dict(model_dict, net)
+    df_summary, _ = color_region_summary(verisig_result_path, samples)  # color regions
+    colors = df_summary['color'].to_numpy()
+
+    # Queue the red regions in decreasing avg robustness (greedy order in ease of repair)
+    region_queue = RegionQueue.from_summary(df_summary)
+
+    # Get good states - for computation efficiency, take up to 5 good states to be protected per region
+    red_good = samples.indices(np.flatnonzero(colors == 'red'))
+    red_good = red_good[samples.robustness[red_good] >= 0.0]
+    red_good_regions = samples.regions[red_good]
+    red_good = red_good[np.arange(len(red_good)) - np.searchsorted(red_good_regions, red_good_regions) < 5]
+    good = np.concatenate([red_good, samples.indices(np.flatnonzero(colors == 'yellow'), head=5),
+                           samples.indices(np.flatnonzero(colors == 'green'), head=5)])
+
+    # Deduplicated, checked most fragile first
+    good_states = GoodStateStore(benchmark, samples.states[good], margins=samples.robustness[good], regions=samples.regions[good],
+                                 max_size=max_good_states)
+
+    # Load controller network to be repaired, as an immutable version
+    with open(net_path, 'rb') as f:
+        model_dict = yaml.safe_load(f)
+    net = NetworkSnapshot.from_model_dict(model_dict, benchmark=benchmark)
 
     iter_num = 0
-    count_red_regions = len(region_robustness)
+    count_red_regions = len(region_queue)
     print(f'Count red regions: {count_red_regions}')
 
-    prev_regions = []
     cases_result = {'NS': 0, 'NF': 0, 'IS': 0, 'IF': 0}
+    num_samples_checked, num_samples_stale = 0, 0
+    probe_generator = np.random.default_rng(0)  # incremental check probes, apart from the torch RNG of the repair
 
-    # Simulated annealing main loop
-    while len(region_robustness) > 0:
-
-        print(f'Remaining regions to be repaired: {len(region_robustness)}')
+    # Worker processes shared by the annealing chains of all regions
+    if annealing_chains > 1:
+        annealing_workers = min(annealing_chains, os.cpu_count()) if annealing_workers is None else annealing_workers
+        annealing_pool = make_annealing_pool(annealing_workers)
 
-        bad_region_id = region_robustness[0][0]  # get next region to repair
-        df_region = df_sample[df_sample['region'] == bad_region_id]
-        df_region_bad = df_region[df_region['result'] < 0.0]
+    # Simulated annealing main loop
+    while len(region_queue) > 0:
 
-        if benchmark == 'uuv':
-            bad_states = [(row['y'], row['h']) for index, row in df_region_bad.iterrows()]
-        elif benchmark == 'mc':
-            bad_states = [(row['pos'], row['vel']) for index, row in df_region_bad.iterrows()]
-        else:
-            raise NotImplementedError
+        print(f'Remaining regions to be repaired: {len(region_queue)}')
 
-        if bad_region_id in prev_regions:
-            print('Already worked on this region, pass')
-            del region_robustness[0]
-            iter_num += 1
-            continue
+        bad_region_id, _ = region_queue.pop()  # get next region to repair
+        bad_states = samples.region_states(bad_region_id)[samples.region_robustness(bad_region_id) < 0.0]
 
         if len(bad_states) == 0:
             print('No bad states identified')
-            del region_robustness[0]
             iter_num += 1
             continue
 
         print(f'Bad states identified: {bad_states}')
 
-        # Simulated annealing
-        net_updated = simulated_annealing(bad_region_id, net, bad_states, benchmark=benchmark)
+        # Simulated annealing, net stays the version before and net_updated is the accepted version after
+        if repair_method == 'gradient':
+            net_updated, _ = gradient_repair(bad_region_id, net, bad_states, good_states, benchmark=benchmark, **(gradient_options or {}))
+        elif annealing_chains > 1:
+            net_updated, _ = parallel_tempering_annealing(bad_region_id, net, bad_states, num_chains=annealing_chains, swap_interval=swap_interval,
+                                                          benchmark=benchmark, pool=annealing_pool)
+        else:
+            net_updated, _ = simulated_annealing(bad_region_id, net, bad_states, benchmark=benchmark,
+                                                 subspace=perturbation_subspace(subspace, net, bad_states), **(annealing_options or {}))
 
         # Step 1 after sim annealing update: Check if bad region is repaired
+        # Versions accepted by simulated_annealing and the starting version are cached, others are simulated here
         t1 = time.time()
-        h_robustness_bad_prev = []
-        h_robustness_bad = []
-        repaired_states = []
-        for bad_state in bad_states:
-            if benchmark == 'uuv':
-                _, traj_y_bad = uuv_simulate(net=net_updated, init_global_heading_deg=bad_state[0], init_pos_y=bad_state[1])
-                robustness = uuv_robustness(traj_y_bad)
-                _, traj_y_bad_prev = uuv_simulate(net=net, init_global_heading_deg=bad_state[0], init_pos_y=bad_state[1])
-                robustness_prev = uuv_robustness(traj_y_bad_prev)
-            elif benchmark == 'mc':
-                traj_pos_bad, _ = mc_simulate(net=net_updated, pos_0=bad_state[0], vel_0=bad_state[1])
-                robustness = mc_robustness(traj_pos_bad)
-                traj_pos_bad_prev, _ = mc_simulate(net=net, pos_0=bad_state[0], vel_0=bad_state[1])
-                robustness_prev = mc_robustness(traj_pos_bad_prev)
-            else:
-                raise NotImplementedError
-            if robustness >= 0.0:
-                repaired_states += [bad_state]
-            h_robustness_bad += [robustness]
-            h_robustness_bad_prev += [robustness_prev]
+        bad_states_array = states_to_array(bad_states)
+        if benchmark == 'uuv':
+            h_robustness_bad = uuv_simulate_batch(net_updated, ys=bad_states_array[:, 0], hs=bad_states_array[:, 1], cache=ROBUSTNESS_CACHE)
+            h_robustness_bad_prev = uuv_simulate_batch(net, ys=bad_states_array[:, 0], hs=bad_states_array[:, 1], cache=ROBUSTNESS_CACHE)
+        elif benchmark == 'mc':
+            h_robustness_bad = mc_simulate_batch(net_updated, pos_0=bad_states_array[:, 0], vel_0=bad_states_array[:, 1], cache=ROBUSTNESS_CACHE)
+            h_robustness_bad_prev = mc_simulate_batch(net, pos_0=bad_states_array[:, 0], vel_0=bad_states_array[:, 1], cache=ROBUSTNESS_CACHE)
+        else:
+            raise NotImplementedError
+        repaired_states = bad_states_array[h_robustness_bad >= 0.0]
 
         if len(h_robustness_bad_prev) > 0 and len(h_robustness_bad) > 0:
             print(f'Avg bad states robustness before and after sim annealing: {np.mean(h_robustness_bad_prev)}, {np.mean(h_robustness_bad)}')
@@ -180,7 +339,6 @@ def isari_main(verisig_result_path, sampled_result_path, net_path, output_path,
 
         if len(repaired_states) == 0:
             print('Case NF: bad region is not repaired')
-            del region_robustness[0]
             cases_result['NF'] += 1
             iter_num += 1
             if np.mean(h_robustness_bad) - np.mean(h_robustness_bad_prev) < -0.5:
@@ -189,86 +347,76 @@ def isari_main(verisig_result_path, sampled_result_path, net_path, output_path,
             else:
                 continue
 
-        # Step 2: Check if any good state broken
+        # Step 2: Check if any good state broken, most fragile first, stops at the first broken one
+        # Not cached, net_updated is only kept if this check passes and its good states robustness is not looked up again
         t2 = time.time()
-        h_robustness_good_prev = []
-        h_robustness_good = []
-        for good_state in good_states:
-            if benchmark == 'uuv':
-                _, traj_y_good = uuv_simulate(net=net_updated, init_global_heading_deg=good_state[0], init_pos_y=good_state[1])
-                robustness = uuv_robustness(traj_y_good)
-                _, traj_y_good_prev = uuv_simulate(net=net, init_global_heading_deg=good_state[0], init_pos_y=good_state[1])
-                robustness_prev = uuv_robustness(traj_y_good_prev)
-            elif benchmark == 'mc':
-                traj_pos_good, _ = mc_simulate(net=net_updated, pos_0=good_state[0], vel_0=good_state[1])
-                robustness = mc_robustness(traj_pos_good)
-                traj_pos_good_prev, _ = mc_simulate(net=net, pos_0=good_state[0], vel_0=good_state[1])
-                robustness_prev = mc_robustness(traj_pos_good_prev)
-            else:
-                raise NotImplementedError
-            h_robustness_good += [robustness]
-            h_robustness_good_prev += [robustness_prev]
+        good_states_safe = good_states.all_safe(net_updated)
 
-        if len(h_robustness_good) > 0:
-            print(f'Good states robustness before and after sim annealing, mean / min: {np.mean(h_robustness_good)}, {np.min(h_robustness_good)}')
+        print(f'Good states all safe after sim annealing: {good_states_safe}, {good_states.last_num_simulated} / {len(good_states)} simulated')
         print(f'Computing good states robustness takes {time.time() - t2}')
 
-        if len(h_robustness_good) > 0 and np.min(h_robustness_good) >= 0.0:  # No good state broken
+        if len(good_states) > 0 and good_states_safe:  # No good state broken
             print('Case NS: No good state is broken, update net and continue to next region')
-            good_states += repaired_states  # update good states, preserve our repaired outcome
+            good_states.accept(net_updated)  # margins of the check above
+            good_states.add(repaired_states, margins=h_robustness_bad[h_robustness_bad >= 0.0], regions=bad_region_id)  # update good states, preserve our repaired outcome
             repaired_net_path = os.path.join(output_path, f'tanh_iter_{iter_num}_region_{bad_region_id}.pt')
-            torch.save(net_updated, repaired_net_path)
+            torch.save(net_updated.to_module(), repaired_net_path)
             net_yml_path = os.path.join(output_path, f'tanh_iter_{iter_num}_region_{bad_region_id}.yml')
-            dump_model_dict(net_yml_path, net_updated)
+            dump_model_dict(net_yml_path, net_updated.to_module())
             net = net_updated
 
             # Recompute the red regions and sort
             t3 = time.time()
-            sampled_checkpoint_path = os.path.join(output_path, f'sample_checkpoint_iter_{iter_num}_region_{bad_region_id}.csv')
-            check_samples(repaired_net_path, sampled_result_path, sampled_checkpoint_path)
-            dict_color = color_regions(verisig_result_path, sampled_checkpoint_path)  # recolor regions
-
-            # Update df_sample here
-            df_sample = pd.read_csv(sampled_checkpoint_path)  # Updated robustness of all sampled states
-            red_mask = df_sample['region'].apply(check_red)
-            region_robustness = sort_regions(df_red)  # Update to be repaired regions
-            print(f'New sorted regions: {region_robustness}')
+            sampled_checkpoint_path = os.path.join(output_path, f'sample_checkpoint_iter_{iter_num}_region_{bad_region_id}.{checkpoint_format}')
+            # Updated robustness of all sampled states, kept in memory instead of re-reading the checkpoint
+            samples = check_samples(repaired_net_path, samples, sampled_checkpoint_path, benchmark=benchmark,
+                                    df_prev=samples if incremental_check else None, base=sampled_base_path,
+                                    colored_regions=np.flatnonzero(colors != 'green'), generator=probe_generator)
+            num_samples_checked += len(samples)
+            num_samples_stale += samples.attrs['num_stale']
+            df_summary_prev = df_summary
+            df_summary, _ = color_region_summary(verisig_result_path, samples)  # recolor regions
+            update_region_queue(df_summary_prev, df_summary)  # Update to be repaired regions
+            print(f'Red regions queued: {region_queue}')
             print(f'Re-computing to-be-repaired regions takes {time.time() - t3}')
             cases_result['NS'] += 1
             iter_num += 1
             continue
 
         # Step 3: Bad region repaired, but good state broken, do IBCL interpolation
-        if benchmark == 'uuv':
-            net_mid, success = uuv_ibcl_convex_comb_binary_search(net_lo=net, net_hi=net_updated, bad_states=bad_states, good_states=good_states)
-        elif benchmark == 'mc':
-            net_mid, success = mc_ibcl_convex_comb_binary_search(net_lo=net, net_hi=net_updated, bad_states=bad_states, good_states=good_states)
+        if ibcl_search == 'grid':
+            net_mid, success = ibcl_convex_comb_grid_search(net_lo=net, net_hi=net_updated, bad_states=bad_states, good_states=good_states, benchmark=benchmark)
         else:
-            raise NotImplementedError
+            net_mid, success = ibcl_convex_comb_binary_search(net_lo=net, net_hi=net_updated, bad_states=bad_states, good_states=good_states, benchmark=benchmark)
 
         if success:  # IBCL found an acceptable net
             print('Case IS: IBCL success')
-            good_states += repaired_states  # update good states
+            good_states.accept(net_mid)  # margins of the last check of the search, if it was of net_mid
+            if benchmark == 'uuv':
+                h_robustness_mid = uuv_simulate_batch(net_mid, ys=bad_states_array[:, 0], hs=bad_states_array[:, 1], cache=ROBUSTNESS_CACHE)
+            else:
+                h_robustness_mid = mc_simulate_batch(net_mid, pos_0=bad_states_array[:, 0], vel_0=bad_states_array[:, 1], cache=ROBUSTNESS_CACHE)
+            good_states.add(bad_states_array[h_robustness_mid >= 0.0], margins=h_robustness_mid[h_robustness_mid >= 0.0], regions=bad_region_id)  # update good states
             repaired_net_path = os.path.join(output_path, f'tanh_iter_{iter_num}_region_{bad_region_id}.pt')
-            torch.save(net_updated, repaired_net_path)
+            torch.save(net_mid.to_module(), repaired_net_path)
             net_yml_path = os.path.join(output_path, f'tanh_iter_{iter_num}_region_{bad_region_id}.yml')
-            dump_model_dict(net_yml_path, net_updated)
-            net = net_updated
-            del region_robustness[0]
+            dump_model_dict(net_yml_path, net_mid.to_module())
+            net = net_mid
 
             # Recompute the red regions and sort
             t4 = time.time()
-            sampled_checkpoint_path = os.path.join(output_path, f'sample_checkpoint_iter_{iter_num}_region_{bad_region_id}.csv')
-            check_samples(repaired_net_path, sampled_result_path, sampled_checkpoint_path)
-            dict_color = color_regions(verisig_result_path, sampled_checkpoint_path)  # recolor regions
-
-            # Update df_sample here
-            df_sample = pd.read_csv(sampled_checkpoint_path)  # Updated robustness of all sampled states
-            red_mask = df_sample['region'].apply(check_red)
-            df_red = df_sample[red_mask]
-            region_robustness = sort_regions(df_red)  # Update to be repaired regions
-
-            print(f'New sorted regions: {region_robustness}')
+            sampled_checkpoint_path = os.path.join(output_path, f'sample_checkpoint_iter_{iter_num}_region_{bad_region_id}.{checkpoint_format}')
+            # Updated robustness of all sampled states, kept in memory instead of re-reading the checkpoint
+            samples = check_samples(repaired_net_path, samples, sampled_checkpoint_path, benchmark=benchmark,
+                                    df_prev=samples if incremental_check else None, base=sampled_base_path,
+                                    colored_regions=np.flatnonzero(colors != 'green'), generator=probe_generator)
+            num_samples_checked += len(samples)
+            num_samples_stale += samples.attrs['num_stale']
+            df_summary_prev = df_summary
+            df_summary, _ = color_region_summary(verisig_result_path, samples)  # recolor regions
+            update_region_queue(df_summary_prev, df_summary)  # Update to be repaired regions
+
+            print(f'Red regions queued: {region_queue}')
             print(f'Re-computing to-be-repaired regions takes {time.time() - t4}')
             cases_result['IS'] += 1
             iter_num += 1
@@ -276,18 +424,33 @@ def isari_main(verisig_result_path, sampled_result_path, net_path, output_path,
 
         # IBCL failure
         print('Case IF: IBCL interpolation failure')
-        del region_robustness[0]
         cases_result['IF'] += 1
         iter_num += 1
 
+    if annealing_chains > 1:
+        annealing_pool.close()
+        annealing_pool.join()
+
     print(f'Total time: {time.time() - start_time}')
     print(f'Cases: {cases_result}')
+    print(f'Robustness cache: {ROBUSTNESS_CACHE}')
+    print(f'Good states: {good_states}')
+    print(f'Samples re-checked: {num_samples_checked}, left stale: {num_samples_stale}')
+
+    # Final robustness of all sampled states, the stale samples of the last incremental check are simulated now
+    stale = np.flatnonzero(np.isnan(samples.robustness))
+    if len(stale) > 0:
+        if benchmark == 'uuv':
+            samples.robustness[stale] = uuv_simulate_batch(net, ys=samples.states[stale, 0], hs=samples.states[stale, 1], cache=ROBUSTNESS_CACHE)
+        else:
+            samples.robustness[stale] = mc_simulate_batch(net, pos_0=samples.states[stale, 0], vel_0=samples.states[stale, 1], cache=ROBUSTNESS_CACHE)
+    samples.write(os.path.join(output_path, f'sample_checkpoint_final.{checkpoint_format}'), base=sampled_base_path)
 
     if not small:
         final_net_yml_path = os.path.join(output_path, f'{benchmark}_repaired_network.yml')
     else:
         final_net_yml_path = os.path.join(output_path, f'{benchmark}_repaired_network_small.yml')
-    dump_model_dict(final_net_yml_path, net)
+    dump_model_dict(final_net_yml_path, net.to_module())
     return
 
 
@@ -308,9 +471,37 @@ if __name__ == '__main__':
     parser.add_argument("--benchmark", help="uuv or mc", default="uuv")
     parser.add_argument("--small", help="true or false", default="false")
     parser.add_argument("--network", help="network yml file to be repaired", default=os.path.join('controllers', 'uuv_tanh_2_15_2x32_broken.yml'))
-    parser.add_argument("--verisig_result_path", help="path to verisig result csv", default=os.path.join('uuv_output', 'uuv_broken_verisig_output.csv'))
-    parser.add_argument("--sampled_result_path", help="path to sampling result csv", default=os.path.join('uuv_output', 'uuv_broken_sampling_output.csv'))
+    parser.add_argument("--verisig_result_path", help="path to verisig result, csv or npz", default=os.path.join('uuv_output', 'uuv_broken_verisig_output.csv'))
+    parser.add_argument("--sampled_result_path", help="path to sampling result, csv or npz", default=os.path.join('uuv_output', 'uuv_broken_sampling_output.csv'))
     parser.add_argument("--output_path", help="directory for all output files", default='uuv_output')
+    parser.add_argument("--annealing_chains", help="number of parallel tempering chains, 1 for a single annealing chain", default=1)
+    parser.add_argument("--swap_interval", help="annealing iterations between parallel tempering swaps", default=20)
+    parser.add_argument("--annealing_workers", help="number of worker processes for the chains, by default one per chain", default=None)
+    parser.add_argument("--num_proposals", help="perturbations evaluated together per annealing iteration", default=1)
+    parser.add_argument("--proposal_selection", help="best or sequential, M-H on the best proposal or on each in turn", default='best')
+    parser.add_argument("--early_reject", help="true or false, stop evaluating a proposal once robustness bounds show it is rejected", default="false")
+    parser.add_argument("--repair_method", help="annealing or gradient, optimizer of each red region", default='annealing')
+    parser.add_argument("--gradient_optimizer", help="adam or lbfgs, for --repair_method=gradient", default='adam')
+    parser.add_argument("--gradient_lr", help="learning rate of the gradient optimizer", default=1e-3)
+    parser.add_argument("--proposal", help="gaussian or langevin, annealing proposal kernel", default='gaussian')
+    parser.add_argument("--subspace", help="all, last_layer, layers:fc2,fc3, random:<rank> or pca:<rank>, parameters perturbed by annealing", default='all')
+    parser.add_argument("--ibcl_search", help="binary or grid, IBCL interpolation weight search", default='binary')
+    parser.add_argument("--max_good_states", help="size cap of the good state store, unbounded by default, every region keeps at least one state", default=None)
+    parser.add_argument("--incremental_check", help="true or false, after a repair re-simulate only the green region samples near the safety boundary, others are left stale (nan) until the final checkpoint", default="false")
+    parser.add_argument("--checkpoint_format", help="npz or csv, format of the sample checkpoints", default='npz')
+    parser.add_argument("--adaptive_schedule", help="true or false, tune the annealing std and stop regions early", default="false")
+    parser.add_argument("--target_acceptance", help="acceptance rate the adaptive schedule tunes the std toward", default=0.3)
     args = parser.parse_args()
 
-    isari_main(args.verisig_result_path, args.sampled_result_path, args.network, args.output_path, benchmark=args.benchmark, small=str2bool(args.small))
\ No newline at end of file
+    annealing_options = {'num_proposals': int(args.num_proposals), 'proposal_selection': args.proposal_selection,
+                         'early_reject': str2bool(args.early_reject), 'proposal': args.proposal}
+    if str2bool(args.adaptive_schedule):
+        annealing_options['schedule'] = AdaptiveAnnealingSchedule(target_acceptance=float(args.target_acceptance))
+
+    isari_main(args.verisig_result_path, args.sampled_result_path, args.network, args.output_path, benchmark=args.benchmark, small=str2bool(args.small),
+               annealing_chains=int(args.annealing_chains), swap_interval=int(args.swap_interval),
+               annealing_workers=None if args.annealing_workers is None else int(args.annealing_workers), annealing_options=annealing_options,
+               repair_method=args.repair_method, gradient_options={'optimizer': args.gradient_optimizer, 'lr': float(args.gradient_lr)},
+               subspace=args.subspace, ibcl_search=args.ibcl_search,
+               max_good_states=None if args.max_good_states is None else int(args.max_good_states),
+               incremental_check=str2bool(args.incremental_check), checkpoint_format=args.checkpoint_format)
\ No newline at end of file
@@ -1,9 +1,13 @@
+import os
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
 import yaml
 import scipy.io as sio
 import pandas as pd
+from robustness_cache import RobustnessCache, ROBUSTNESS_CACHE
+from sample_store import SampleStore, read_table, write_table
 
 """ Controller network utils """
 
@@ -75,14 +79,285 @@ def dump_model_dict(filename, network: nn.Module):
     return
 
 
+# Benchmark of a controller network, 'uuv' or 'mc'
+def control_nn_benchmark(network: nn.Module):
+    if isinstance(network, UUV_Control_NN):
+        return 'uuv'
+    elif isinstance(network, MC_Control_NN):
+        return 'mc'
+    else:
+        raise NotImplementedError
+
+
+# Activations of the num_layers layers of a UUV / MC controller network: tanh / sigmoid hidden layers, tanh output layer
+def control_nn_activations(benchmark='uuv', num_layers=3):
+    if benchmark == 'uuv':
+        hidden = 'tanh'
+    elif benchmark == 'mc':
+        hidden = 'sigmoid'
+    else:
+        raise NotImplementedError
+    return [hidden] * (num_layers - 1) + ['tanh']
+
+
+# NumPy copy of a controller network for fast inference in the simulators, any number and sizes of linear layers
+# Weights are compiled once into contiguous float32 arrays (same precision as the torch module),
+# each layer is a fused matmul + bias + activation in place
+class NumpyControlNN:
+
+    def __init__(self, weights, biases, activations, dtype=np.float32):
+        self.dtype = dtype
+        self.weights_t = [np.array(np.swapaxes(W, -1, -2), dtype=dtype, order='C') for W in weights]  # (in, out)
+        self.biases = [np.array(b, dtype=dtype) for b in biases]
+        self.activations = activations  # 'tanh' or 'sigmoid' per layer
+        self._buffers = {}  # preallocated hidden layer outputs per input batch shape
+        self._fingerprint = None
+
+    # Layers in state_dict order, e.g. fc1, fc2, fc3
+    @classmethod
+    def from_module(cls, network: nn.Module):
+        state_dict = network.state_dict()
+        weights = [param.detach().numpy() for name, param in state_dict.items() if name.endswith('.weight')]
+        biases = [param.detach().numpy() for name, param in state_dict.items() if name.endswith('.bias')]
+        return cls(weights, biases, control_nn_activations(control_nn_benchmark(network), len(weights)))
+
+    # Stack K networks of the same architecture, weights become (K, out, in) and inputs (K, N, 2)
+    @classmethod
+    def stack(cls, nets: list):
+        nets = [as_numpy_control_nn(net) for net in nets]
+        assert all(net.activations == nets[0].activations for net in nets), 'Stacked networks must share the architecture'
+        weights = [np.stack([np.swapaxes(net.weights_t[layer], -1, -2) for net in nets]) for layer in range(len(nets[0].weights_t))]
+        biases = [np.stack([net.biases[layer] for net in nets])[:, None, :] for layer in range(len(nets[0].biases))]
+        return cls(weights, biases, nets[0].activations, dtype=nets[0].dtype)
+
+    # Number of stacked networks, or None for a single network
+    @property
+    def num_networks(self):
+        return self.weights_t[0].shape[0] if self.weights_t[0].ndim == 3 else None
+
+    # Activations follow UUV_Control_NN / MC_Control_NN, same as load_model_dict
+    @classmethod
+    def from_model_dict(cls, model_dict: dict, benchmark='uuv'):
+        weights = [model_dict['weights'][layer] for layer in sorted(model_dict['weights'])]
+        biases = [model_dict['offsets'][layer] for layer in sorted(model_dict['offsets'])]
+        return cls(weights, biases, control_nn_activations(benchmark, len(weights)))
+
+    # Overwrite the parameters in place with weights (..., out, in) and biases of the compiled shapes, e.g. views of a flat buffer
+    # The fingerprint is recomputed
+    def load(self, weights, biases):
+        for W_t, W in zip(self.weights_t, weights):
+            np.copyto(W_t, np.swapaxes(W, -1, -2))
+        for b_self, b in zip(self.biases, biases):
+            np.copyto(b_self, b)
+        self._fingerprint = None
+
+    # Only the buffers of the latest batch shape are kept, it is constant over a lockstep simulation
+    def _buffer(self, layer, shape):
+        out_shape = shape[:-1] + (self.weights_t[layer].shape[-1],)
+        if layer not in self._buffers or self._buffers[layer].shape != out_shape:
+            self._buffers[layer] = np.empty(out_shape, dtype=self.dtype)
+        return self._buffers[layer]
+
+    # Stable hash of the architecture and float32 parameters, same for a torch module and its compiled copy
+    def fingerprint(self):
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(','.join(self.activations).encode())
+            for W_t, b in zip(self.weights_t, self.biases):
+                for param in (W_t, b):
+                    digest.update(str(param.shape).encode())
+                    digest.update(np.ascontiguousarray(param, dtype=np.float32).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def _layer(self, layer, x):
+        out = self._buffer(layer, x.shape)
+        np.matmul(x, self.weights_t[layer], out=out)
+        out += self.biases[layer]
+        if self.activations[layer] == 'tanh':
+            np.tanh(out, out=out)
+        else:  # sigmoid(x) = (1 + tanh(x / 2)) / 2, faster than exp
+            out *= 0.5
+            np.tanh(out, out=out)
+            out *= 0.5
+            out += 0.5
+        return out
+
+    # x: (..., 2) array, returns float64 (..., 1) like the torch module
+    def __call__(self, x):
+        x = np.asarray(x, dtype=self.dtype)
+        for layer in range(len(self.weights_t)):
+            x = self._layer(layer, x)
+        return x.astype(np.float64)
+
+
+# Compile a torch controller network to its NumPy copy, NumpyControlNN is returned as is
+# Other network representations, e.g. NetworkSnapshot, provide their own numpy_control_nn()
+def as_numpy_control_nn(net):
+    if isinstance(net, nn.Module):
+        return NumpyControlNN.from_module(net)
+    elif isinstance(net, NumpyControlNN):
+        return net
+    return net.numpy_control_nn()
+
+
+# Ranges (low, high) of the controller inputs per benchmark: UUV (pipe heading, standoff range) within the y bounds [10, 50],
+# MC (pos, vel) within the simulator constraints
+CONTROL_NN_INPUT_RANGE = {'uuv': ([-np.pi, 10.0], [np.pi, 50.0]), 'mc': ([-1.2, -0.07], [0.6, 0.07])}
+
+
+# Max abs difference between the torch and NumPy forward passes on random inputs, raise if above atol
+# Inputs are drawn from CONTROL_NN_INPUT_RANGE of the benchmark of network by default, without touching the global RNG
+def check_numpy_control_nn(network: nn.Module, numpy_net: NumpyControlNN, inputs=None, atol=1e-5):
+    if inputs is None:
+        low, high = CONTROL_NN_INPUT_RANGE[control_nn_benchmark(network)]
+        inputs = np.random.default_rng(0).uniform(low=low, high=high, size=(1000, 2))
+    with torch.no_grad():
+        torch_out = network(torch.FloatTensor(inputs)).numpy()
+    max_error = np.max(np.abs(torch_out - numpy_net(inputs)))
+    assert max_error <= atol, f'NumPy controller deviates from torch by {max_error}'
+    return max_error
+
+
+# Controller outputs of a batch of inputs as a float64 array (..., 1), on a torch module or a NumpyControlNN
+def control_nn_forward(net, inputs):
+    if isinstance(net, nn.Module):
+        with torch.no_grad():
+            return net(torch.FloatTensor(inputs)).numpy().astype(np.float64)
+    return net(inputs)
+
+
+# Slices of [0, num_states) in chunks of chunk_size, one chunk if chunk_size is None
+def state_chunks(num_states, chunk_size=None):
+    chunk_size = num_states if chunk_size is None else chunk_size
+    return [slice(start, start + chunk_size) for start in range(0, num_states, max(chunk_size, 1))]
+
+
+# Stack a list of state tuples, e.g. (y, h) or (y, h, result), into an (N, k) float array, first two columns are the state
+def states_to_array(states):
+    states = np.array(states, dtype=np.float64)
+    if states.size == 0:
+        return np.zeros((0, 2))
+    return states.reshape(len(states), -1)
+
+
+# Upper bounds of the robustness of states (N, k), simulated chunk by chunk until they cannot reach threshold on average
+# simulate(states, stop_below) returns upper bounds of the robustness of a chunk, exact unless their sum is below stop_below
+# Returns the robustness upper bounds, exact for all states if their mean reaches threshold, and the mask of simulated states
+def bounded_robustness(simulate, states, upper_bounds, threshold, chunk_size=None):
+    robustness = np.array(upper_bounds, dtype=np.float64)
+    simulated = np.zeros(len(states), dtype=bool)
+    target = threshold * len(states)
+    for chunk in state_chunks(len(states), chunk_size):
+        total = np.sum(robustness)
+        if total < target:
+            break
+        robustness[chunk] = simulate(states[chunk], target - (total - np.sum(robustness[chunk])))
+        simulated[chunk] = True
+    return robustness, simulated
+
+
+# Log barrier of good states robustness, log(robustness) floored at -1000, and -1000 if not positive
+def robustness_log_barriers(h_robustness_good):
+    log_barriers = np.full(len(h_robustness_good), -1000.0)
+    positive = h_robustness_good > 0.0
+    log_barriers[positive] = np.maximum(np.log(h_robustness_good[positive]), -1000.0)
+    return log_barriers
+
+
+# robustness_log_barriers of a torch tensor, differentiable where robustness is positive
+def robustness_log_barriers_torch(h_robustness_good):
+    positive = h_robustness_good > 0.0
+    log_robustness = torch.log(torch.where(positive, h_robustness_good, torch.ones_like(h_robustness_good)))
+    return torch.where(positive, torch.clamp(log_robustness, min=-1000.0), torch.full_like(h_robustness_good, -1000.0))
+
+
+# Minimum along dim, smoothed into -temperature * logsumexp(-x / temperature) if temperature > 0, which is at most the minimum
+def soft_min(x, temperature=0.0, dim=0):
+    if temperature > 0:
+        return -temperature * torch.logsumexp(-x / temperature, dim=dim)
+    return torch.min(x, dim=dim).values
+
+
+# Maximum along dim, smoothed into temperature * logsumexp(x / temperature) if temperature > 0, which is at least the maximum
+def soft_max(x, temperature=0.0, dim=0):
+    if temperature > 0:
+        return temperature * torch.logsumexp(x / temperature, dim=dim)
+    return torch.max(x, dim=dim).values
+
+
 """ UUV utils """
 
 
+UUV_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uuv_model_oneHz.mat')
+
+
+# Linear UUV dynamics y = Cx + Du, x' = Ax + Bu, held as read-only contiguous float64 arrays
+class UUVDynamics:
+
+    def __init__(self, A, B, C, D):
+        self.A, self.B, self.C, self.D = [self._read_only(m) for m in (A, B, C, D)]
+        self._fingerprint = None
+
+    @staticmethod
+    def _read_only(m):
+        m = np.array(m, dtype=np.float64, order='C')
+        m.flags.writeable = False
+        return m
+
+    @classmethod
+    def from_mat(cls, model_path=UUV_MODEL_PATH):
+        coeffs = sio.loadmat(model_path)
+        return cls(coeffs['A'], coeffs['B'], coeffs['C'], coeffs['D'])
+
+    # Stable hash of the 4 matrices, part of the robustness cache key of UUV simulations
+    def fingerprint(self):
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for m in (self.A, self.B, self.C, self.D):
+                digest.update(str(m.shape).encode())
+                digest.update(m.tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    # Pickled to worker processes as the 4 matrices, read-only again after unpickling
+    def __reduce__(self):
+        return UUVDynamics, (self.A, self.B, self.C, self.D)
+
+
+_uuv_dynamics = None
+
+
+# Dynamics shared by all simulations of this process, loaded from UUV_MODEL_PATH on first use
+def get_uuv_dynamics():
+    global _uuv_dynamics
+    if _uuv_dynamics is None:
+        _uuv_dynamics = UUVDynamics.from_mat()
+    return _uuv_dynamics
+
+
+# Install already loaded dynamics in this process, e.g. as a process pool initializer
+def set_uuv_dynamics(dynamics: UUVDynamics):
+    global _uuv_dynamics
+    _uuv_dynamics = dynamics
+
+
+# Robustness cache key of the simulations of a benchmark: the robustness also depends on the dynamics (UUV),
+# or on length and steepness (MC)
+def simulation_cache_key(benchmark, dynamics: UUVDynamics = None, length=111, steepness=0.0025):
+    if benchmark == 'uuv':
+        return 'uuv', (get_uuv_dynamics() if dynamics is None else dynamics).fingerprint()
+    elif benchmark == 'mc':
+        return 'mc', length, steepness
+    else:
+        raise NotImplementedError
+
+
 # Simulate, init_global_heading is in degrees
-def uuv_simulate(net: UUV_Control_NN, init_global_heading_deg, init_pos_y):
+def uuv_simulate(net: UUV_Control_NN, init_global_heading_deg, init_pos_y, dynamics: UUVDynamics = None):
     # Dynamics coeff matrices
-    coeffs = sio.loadmat('uuv_model_oneHz.mat')
-    A, B, C, D = coeffs['A'], coeffs['B'], coeffs['C'], coeffs['D']
+    dynamics = get_uuv_dynamics() if dynamics is None else dynamics
+    A, B, C, D = dynamics.A, dynamics.B, dynamics.C, dynamics.D
 
     init_global_heading = init_global_heading_deg / 180 * np.pi
     x = np.array([[0], [0], [0], [0]])
@@ -115,8 +390,7 @@ def uuv_simulate(net: UUV_Control_NN, init_global_heading_deg, init_pos_y):
         # Control u update
         pipe_heading = -1.0 * global_heading
         stdb_range = pos_y / np.cos(global_heading)
-        nn_inputs = torch.FloatTensor([pipe_heading, stdb_range])
-        nn_out = net(nn_inputs).detach().numpy()[0]
+        nn_out = control_nn_forward(net, [pipe_heading, stdb_range])[0]
         heading_delta = np.radians(5) * nn_out
         abs_heading = heading_delta + heading
         abs_heading = abs_heading if abs_heading < np.pi else abs_heading - 2 * np.pi
@@ -132,50 +406,235 @@ def uuv_robustness(traj_pos_y):
     return np.min(scores)
 
 
+# Upper bound of the robustness of each initial state under any network, the margin of the initial position
+def uuv_robustness_upper_bounds(ys, hs):
+    pos_y = np.array(ys, dtype=np.float64).reshape(-1)
+    return np.minimum(50 - pos_y, pos_y - 10)
+
+
+# Closed-loop UUV rollout of arrays of initial states (any shape S) in lockstep, returns robustness of shape S
+# net is a NumpyControlNN, stacked over K networks if S = (K, N)
+# With stop_on_violation, all trajectories stop as soon as any robustness is negative (only its sign is exact then)
+# With stop_below, all trajectories stop as soon as the robustness sum is below it, robustness is an upper bound then
+def _uuv_rollout(net, pos_y, init_global_heading_deg, dynamics: UUVDynamics, stop_on_violation=False, stop_below=None):
+    A, B, C, D = dynamics.A, dynamics.B, dynamics.C, dynamics.D
+
+    shape = pos_y.shape
+    init_global_heading = init_global_heading_deg / 180 * np.pi
+    x = np.zeros((4,) + shape)
+    u = np.stack([np.zeros(shape), np.full(shape, 0.48556), np.full(shape, 45.0)])
+    pos_x = np.zeros(shape)
+
+    robustness = np.minimum(50 - pos_y, pos_y - 10)
+    active = np.ones(shape, dtype=bool)  # trajectories not early stopped yet
+
+    for i in range(30):
+
+        # Compute y and x
+        y = np.tensordot(C, x, axes=1) + np.tensordot(D, u, axes=1)
+        x = np.tensordot(A, x, axes=1) + np.tensordot(B, u, axes=1)
+
+        # Update pos_x, pos_y of active trajectories only, early stopped ones are frozen
+        heading = y[0]
+        heading = np.where(heading < np.pi, heading, heading - 2 * np.pi)
+        global_heading = heading + init_global_heading
+        pos_x = np.where(active, pos_x + y[1] * np.cos(global_heading), pos_x)
+        pos_y = np.where(active, pos_y - y[1] * np.sin(global_heading), pos_y)
+        robustness = np.where(active, np.minimum(robustness, np.minimum(50 - pos_y, pos_y - 10)), robustness)
+
+        # Early stop
+        active &= (pos_y >= 10) & (pos_y <= 50) & (pos_x >= -10) & (pos_x <= 400)
+        if not active.any():
+            break
+        if stop_on_violation and (robustness < 0).any():
+            break
+        if stop_below is not None and np.sum(robustness) < stop_below:  # the running minimum only decreases
+            break
+
+        # Control u update, one network call on the whole batch
+        pipe_heading = -1.0 * global_heading
+        stdb_range = pos_y / np.cos(global_heading)
+        nn_out = net(np.stack([pipe_heading, stdb_range], axis=-1))[..., 0]
+        heading_delta = np.radians(5) * nn_out
+        abs_heading = heading_delta + heading
+        abs_heading = np.where(abs_heading < np.pi, abs_heading, abs_heading - 2 * np.pi)
+        u = np.stack([abs_heading, np.full(shape, 0.48556), np.full(shape, 45.0)])
+
+    return robustness
+
+
+# Simulate N initial states in lockstep, init_global_heading (hs) is in degrees
+# Returns the STL robustness of all N trajectories, same as uuv_robustness(uuv_simulate(...)[1]) per state
+# With decision, returns robustness >= 0 only, each trajectory already stops at its first step outside [10, 50]
+# With a RobustnessCache, only the states not cached for this network are simulated
+def uuv_simulate_batch(net: UUV_Control_NN, ys, hs, dynamics: UUVDynamics = None, decision=False, cache: RobustnessCache = None):
+    dynamics = get_uuv_dynamics() if dynamics is None else dynamics
+    net = as_numpy_control_nn(net)
+    pos_y = np.array(ys, dtype=np.float64).reshape(-1)
+    init_global_heading_deg = np.array(hs, dtype=np.float64).reshape(-1)
+    if cache is None:
+        robustness = _uuv_rollout(net, pos_y, init_global_heading_deg, dynamics)
+    else:
+        states = np.stack([pos_y, init_global_heading_deg], axis=1)
+        robustness, missing = cache.lookup(simulation_cache_key('uuv', dynamics), net.fingerprint(), states)
+        if missing.any():
+            robustness[missing] = _uuv_rollout(net, pos_y[missing], init_global_heading_deg[missing], dynamics)
+            cache.store(simulation_cache_key('uuv', dynamics), net.fingerprint(), states[missing], robustness[missing])
+    return robustness >= 0 if decision else robustness
+
+
+# True if all initial states have non-negative robustness, stops at the first violation
+# States are simulated in chunks of chunk_size, the remaining chunks are skipped once one is violated
+def uuv_all_safe(net: UUV_Control_NN, ys, hs, chunk_size=None, dynamics: UUVDynamics = None, cache: RobustnessCache = None):
+    dynamics = get_uuv_dynamics() if dynamics is None else dynamics
+    net = as_numpy_control_nn(net)
+    pos_y = np.array(ys, dtype=np.float64).reshape(-1)
+    init_global_heading_deg = np.array(hs, dtype=np.float64).reshape(-1)
+    states = np.stack([pos_y, init_global_heading_deg], axis=1)
+    if cache is not None:
+        robustness, missing = cache.lookup(simulation_cache_key('uuv', dynamics), net.fingerprint(), states)
+        if (robustness[~missing] < 0).any():
+            return False
+        states = states[missing]
+    for chunk in state_chunks(len(states), chunk_size):
+        robustness = _uuv_rollout(net, states[chunk, 0], states[chunk, 1], dynamics, stop_on_violation=True)
+        if (robustness < 0).any():
+            return False
+        if cache is not None:  # no violation, so the rollout ran in full and robustness is exact
+            cache.store(simulation_cache_key('uuv', dynamics), net.fingerprint(), states[chunk], robustness)
+    return True
+
+
+# True if any initial state has non-negative robustness, the remaining chunks are skipped once one is found
+def uuv_any_safe(net: UUV_Control_NN, ys, hs, chunk_size=None, dynamics: UUVDynamics = None, cache: RobustnessCache = None):
+    dynamics = get_uuv_dynamics() if dynamics is None else dynamics
+    net = as_numpy_control_nn(net)
+    pos_y = np.array(ys, dtype=np.float64).reshape(-1)
+    init_global_heading_deg = np.array(hs, dtype=np.float64).reshape(-1)
+    states = np.stack([pos_y, init_global_heading_deg], axis=1)
+    if cache is not None:
+        robustness, missing = cache.lookup(simulation_cache_key('uuv', dynamics), net.fingerprint(), states)
+        if (robustness[~missing] >= 0).any():
+            return True
+        states = states[missing]
+    for chunk in state_chunks(len(states), chunk_size):
+        robustness = _uuv_rollout(net, states[chunk, 0], states[chunk, 1], dynamics)
+        if cache is not None:
+            cache.store(simulation_cache_key('uuv', dynamics), net.fingerprint(), states[chunk], robustness)
+        if (robustness >= 0).any():
+            return True
+    return False
+
+
+# Differentiable closed-loop UUV rollout of N initial states in lockstep, net is a torch module
+# Returns the robustness as a float64 tensor of N, with the minimum over steps and bounds smoothed by soft_min(temperature)
+# temperature=0 gives the exact robustness of uuv_simulate_batch, up to float32 network precision
+def uuv_simulate_torch(net: UUV_Control_NN, ys, hs, temperature=0.0, dynamics: UUVDynamics = None):
+    dynamics = get_uuv_dynamics() if dynamics is None else dynamics
+    A, B, C, D = (torch.tensor(M) for M in (dynamics.A, dynamics.B, dynamics.C, dynamics.D))
+
+    pos_y = torch.as_tensor(np.array(ys, dtype=np.float64).reshape(-1))
+    init_global_heading = torch.as_tensor(np.array(hs, dtype=np.float64).reshape(-1)) / 180 * np.pi
+    num_states = len(pos_y)
+    x = torch.zeros(4, num_states, dtype=torch.float64)
+    u = torch.stack([torch.zeros(num_states), torch.full((num_states,), 0.48556), torch.full((num_states,), 45.0)]).double()
+    pos_x = torch.zeros(num_states, dtype=torch.float64)
+
+    def margin(pos_y):
+        return soft_min(torch.stack([50 - pos_y, pos_y - 10]), temperature)
+
+    margins = [margin(pos_y)]
+    active = torch.ones(num_states, dtype=torch.bool)  # trajectories not early stopped yet
+
+    for i in range(30):
+
+        # Compute y and x
+        y = C @ x + D @ u
+        x = A @ x + B @ u
+
+        # Update pos_x, pos_y of active trajectories only, early stopped ones do not add margins
+        heading = torch.where(y[0] < np.pi, y[0], y[0] - 2 * np.pi)
+        global_heading = heading + init_global_heading
+        pos_x = torch.where(active, pos_x + y[1] * torch.cos(global_heading), pos_x)
+        pos_y = torch.where(active, pos_y - y[1] * torch.sin(global_heading), pos_y)
+        margins.append(torch.where(active, margin(pos_y), torch.full_like(pos_y, np.inf)))
+
+        # Early stop
+        active = active & (pos_y >= 10) & (pos_y <= 50) & (pos_x >= -10) & (pos_x <= 400)
+        if not active.any():
+            break
+
+        # Control u update, one network call on the whole batch
+        pipe_heading = -1.0 * global_heading
+        stdb_range = pos_y / torch.cos(global_heading)
+        nn_out = net(torch.stack([pipe_heading, stdb_range], dim=-1).float()).double()[:, 0]
+        heading_delta = np.radians(5) * nn_out
+        abs_heading = heading_delta + heading
+        abs_heading = torch.where(abs_heading < np.pi, abs_heading, abs_heading - 2 * np.pi)
+        u = torch.stack([abs_heading, torch.full_like(abs_heading, 0.48556), torch.full_like(abs_heading, 45.0)])
+
+    return soft_min(torch.stack(margins), temperature)
+
+
+# Upper bounds of the robustness of N initial states, simulated in lockstep until their sum is below stop_below
+# Exact robustness if it never is
+def uuv_simulate_bounded(net: UUV_Control_NN, ys, hs, stop_below, dynamics: UUVDynamics = None):
+    dynamics = get_uuv_dynamics() if dynamics is None else dynamics
+    pos_y = np.array(ys, dtype=np.float64).reshape(-1)
+    init_global_heading_deg = np.array(hs, dtype=np.float64).reshape(-1)
+    return _uuv_rollout(as_numpy_control_nn(net), pos_y, init_global_heading_deg, dynamics, stop_below=stop_below)
+
+
+# Simulate K networks of the same architecture on the same N initial states, returns a (K, N) robustness matrix
+def uuv_simulate_population(nets: list, ys, hs, dynamics: UUVDynamics = None):
+    dynamics = get_uuv_dynamics() if dynamics is None else dynamics
+    stacked_net = NumpyControlNN.stack(nets)
+    shape = (stacked_net.num_networks, np.size(ys))
+    pos_y = np.broadcast_to(np.array(ys, dtype=np.float64).reshape(-1), shape)
+    init_global_heading_deg = np.broadcast_to(np.array(hs, dtype=np.float64).reshape(-1), shape)
+    return _uuv_rollout(stacked_net, pos_y, init_global_heading_deg, dynamics)
+
+
 # Objective function of UUV
-def uuv_barriered_energy(bad_states, good_states, net, lambda_=1.0):
-    h_robustness_bad = []
-    for bad_state in bad_states:
-        _, traj_y_bad = uuv_simulate(net=net, init_pos_y=bad_state[0], init_global_heading_deg=bad_state[1])
-        h_robustness_bad += [uuv_robustness(traj_y_bad)]
-
-    log_barriers = []
-    h_robustness_good = []
-    for good_state in good_states:
-        _, traj_y_good = uuv_simulate(net=net, init_pos_y=good_state[0], init_global_heading_deg=good_state[1])
-        robustness = uuv_robustness(traj_y_good)
-        h_robustness_good += [robustness]
-        if robustness > 0.0 and np.log(robustness) > -1000:
-            log_barrier = np.log(robustness)
-        else:
-            log_barrier = -1000
-        log_barriers += [log_barrier]
+def uuv_barriered_energy(bad_states, good_states, net, lambda_=1.0, cache: RobustnessCache = ROBUSTNESS_CACHE):
+    bad_states = states_to_array(bad_states)
+    h_robustness_bad = uuv_simulate_batch(net, ys=bad_states[:, 0], hs=bad_states[:, 1], cache=cache)
 
-    return lambda_ * np.mean(h_robustness_bad) + np.mean(log_barriers), h_robustness_bad, h_robustness_good
+    good_states = states_to_array(good_states)
+    h_robustness_good = uuv_simulate_batch(net, ys=good_states[:, 0], hs=good_states[:, 1], cache=cache)
+    log_barriers = robustness_log_barriers(h_robustness_good)
 
+    barrier = np.mean(log_barriers) if len(log_barriers) > 0 else 0.0
+    return lambda_ * np.mean(h_robustness_bad) + barrier, h_robustness_bad, h_robustness_good
 
-def uuv_energy(bad_states, net):
-    h_robustness_bad = []
-    for bad_state in bad_states:
-        _, traj_y_bad = uuv_simulate(net=net, init_pos_y=bad_state[0], init_global_heading_deg=bad_state[1])
-        h_robustness_bad += [uuv_robustness(traj_y_bad)]
+
+def uuv_energy(bad_states, net, cache: RobustnessCache = ROBUSTNESS_CACHE):
+    bad_states = states_to_array(bad_states)
+    h_robustness_bad = uuv_simulate_batch(net, ys=bad_states[:, 0], hs=bad_states[:, 1], cache=cache)
     return np.mean(h_robustness_bad)
 
 
+# uuv_energy of K networks in one population simulation, returns a (K,) array
+def uuv_energy_population(bad_states, nets: list):
+    bad_states = states_to_array(bad_states)
+    h_robustness_bad = uuv_simulate_population(nets, ys=bad_states[:, 0], hs=bad_states[:, 1])
+    return np.mean(h_robustness_bad, axis=1)
+
+
 """ MC utils """
 
 
 # Simulate traj_pos and traj_vel from an initial state (replace this with actual simulator later)
 def mc_simulate(pos_0, vel_0, net: MC_Control_NN, length=111, steepness=0.0025):
-    net.eval()
+    if isinstance(net, nn.Module):
+        net.eval()
     traj_pos = np.zeros(length)
     traj_vel = np.zeros(length)
     traj_pos[0] = pos_0
     traj_vel[0] = vel_0
     for i in range(1, length):
         traj_pos[i] = traj_pos[i - 1] + traj_vel[i - 1]
-        inputs = torch.FloatTensor([traj_pos[i - 1], traj_vel[i - 1]])
-        u = net(inputs).detach().numpy()
+        u = control_nn_forward(net, [traj_pos[i - 1], traj_vel[i - 1]])[0]
         traj_vel[i] = traj_vel[i - 1] + 0.0015 * u - steepness * np.cos(3 * traj_pos[i - 1])
         # simulator constraints
         if (traj_vel[i] > 0.07): traj_vel[i] = 0.07
@@ -191,97 +650,235 @@ def mc_robustness(traj_pos):
     return np.max(traj_pos) - 0.45
 
 
-# Objective function
-def mc_barriered_energy(bad_states, good_states, net, lambda_=1.0):
-    h_robustness_bad = []
-    for bad_state in bad_states:
-        traj_pos_bad, _ = mc_simulate(bad_state[0], bad_state[1], net)
-        h_robustness_bad += [mc_robustness(traj_pos_bad)]
-
-    log_barriers = []
-    h_robustness_good = []
-    for good_state in good_states:
-        traj_pos_good, _ = mc_simulate(good_state[0], good_state[1], net)
-        robustness = mc_robustness(traj_pos_good)
-        h_robustness_good += [robustness]
-        if robustness > 0.0 and np.log(robustness) > -1000:
-            log_barrier = np.log(robustness)
-        else:
-            log_barrier = -1000
-        log_barriers += [log_barrier]
+# Upper bound of mc_robustness of each initial state under any network, positions are clipped at 0.6
+def mc_robustness_upper_bounds(pos_0, vel_0):
+    return np.full(np.size(pos_0), 0.6 - 0.45)
 
-    return lambda_ * np.mean(h_robustness_bad) + np.mean(log_barriers), h_robustness_bad, h_robustness_good
 
+# Closed-loop MC rollout of arrays of initial states (any shape S) in lockstep, returns mc_robustness of shape S
+# net is a NumpyControlNN, stacked over K networks if S = (K, N)
+# With stop_below, all trajectories stop as soon as the sum of robustness upper bounds is below it, and those are returned
+# Positions still to come are bounded by the maximum velocity 0.07 and the position limit 0.6
+def _mc_rollout(net, pos, vel, length=111, steepness=0.0025, stop_below=None):
+    max_pos = pos.copy()
+    for i in range(1, length):
+        u = net(np.stack([pos, vel], axis=-1))[..., 0]
+        pos, vel = pos + vel, vel + 0.0015 * u - steepness * np.cos(3 * pos)
+        # simulator constraints
+        vel = np.clip(vel, -0.07, 0.07)
+        pos = np.clip(pos, -1.2, 0.6)
+        vel[(pos == -1.2) & (vel < 0)] = 0
+        max_pos = np.maximum(max_pos, pos)
+        if stop_below is not None and 0.07 * (length - 1 - i) < 0.6 + 1.2:  # earlier, any position is reachable
+            bound = np.maximum(max_pos, np.minimum(pos + 0.07 * (length - 1 - i), 0.6)) - 0.45
+            if np.sum(bound) < stop_below:
+                return bound
+    return max_pos - 0.45
+
+
+# Sign of mc_robustness of N initial states, each trajectory is dropped from the batch once it reaches pos >= 0.45
+# With stop_on_safe, all trajectories stop as soon as any of them reaches it
+def _mc_decide(net, pos, vel, length=111, steepness=0.0025, stop_on_safe=False):
+    safe = pos >= 0.45
+    undecided = np.flatnonzero(~safe)
+    pos, vel = pos[undecided], vel[undecided]
+    for i in range(1, length):
+        if len(undecided) == 0 or (stop_on_safe and safe.any()):
+            break
+        u = net(np.stack([pos, vel], axis=-1))[..., 0]
+        pos, vel = pos + vel, vel + 0.0015 * u - steepness * np.cos(3 * pos)
+        # simulator constraints
+        vel = np.clip(vel, -0.07, 0.07)
+        pos = np.clip(pos, -1.2, 0.6)
+        vel[(pos == -1.2) & (vel < 0)] = 0
+        reached = pos >= 0.45
+        safe[undecided[reached]] = True
+        undecided, pos, vel = undecided[~reached], pos[~reached], vel[~reached]
+    return safe
+
+
+# Simulate N initial states in lockstep, returns mc_robustness of all N trajectories
+# With decision, returns mc_robustness >= 0 only, and each trajectory stops as soon as it reaches pos >= 0.45
+# With a RobustnessCache, only the states not cached for this network are simulated, decisions are not cached
+def mc_simulate_batch(net: MC_Control_NN, pos_0, vel_0, length=111, steepness=0.0025, decision=False, cache: RobustnessCache = None):
+    net = as_numpy_control_nn(net)
+    pos = np.array(pos_0, dtype=np.float64).reshape(-1)
+    vel = np.array(vel_0, dtype=np.float64).reshape(-1)
+    simulation = simulation_cache_key('mc', length=length, steepness=steepness)
+    if cache is None:
+        robustness, missing = np.full(len(pos), np.nan), np.ones(len(pos), dtype=bool)
+    else:
+        robustness, missing = cache.lookup(simulation, net.fingerprint(), np.stack([pos, vel], axis=1))
+    if decision:
+        safe = robustness >= 0
+        safe[missing] = _mc_decide(net, pos[missing], vel[missing], length=length, steepness=steepness)
+        return safe
+    if missing.any():
+        robustness[missing] = _mc_rollout(net, pos[missing], vel[missing], length=length, steepness=steepness)
+        if cache is not None:
+            cache.store(simulation, net.fingerprint(), np.stack([pos[missing], vel[missing]], axis=1), robustness[missing])
+    return robustness
+
+
+# True if all initial states have non-negative robustness
+# States are decided in chunks of chunk_size, the remaining chunks are skipped once one is violated
+def mc_all_safe(net: MC_Control_NN, pos_0, vel_0, chunk_size=256, length=111, steepness=0.0025, cache: RobustnessCache = None):
+    net = as_numpy_control_nn(net)
+    pos = np.array(pos_0, dtype=np.float64).reshape(-1)
+    vel = np.array(vel_0, dtype=np.float64).reshape(-1)
+    if cache is not None:
+        robustness, missing = cache.lookup(simulation_cache_key('mc', length=length, steepness=steepness), net.fingerprint(),
+                                           np.stack([pos, vel], axis=1))
+        if (robustness[~missing] < 0).any():
+            return False
+        pos, vel = pos[missing], vel[missing]
+    for chunk in state_chunks(len(pos), chunk_size):
+        if not _mc_decide(net, pos[chunk], vel[chunk], length=length, steepness=steepness).all():
+            return False
+    return True
+
+
+# True if any initial state has non-negative robustness, stops as soon as one trajectory reaches pos >= 0.45
+def mc_any_safe(net: MC_Control_NN, pos_0, vel_0, chunk_size=None, length=111, steepness=0.0025, cache: RobustnessCache = None):
+    net = as_numpy_control_nn(net)
+    pos = np.array(pos_0, dtype=np.float64).reshape(-1)
+    vel = np.array(vel_0, dtype=np.float64).reshape(-1)
+    if cache is not None:
+        robustness, missing = cache.lookup(simulation_cache_key('mc', length=length, steepness=steepness), net.fingerprint(),
+                                           np.stack([pos, vel], axis=1))
+        if (robustness[~missing] >= 0).any():
+            return True
+        pos, vel = pos[missing], vel[missing]
+    for chunk in state_chunks(len(pos), chunk_size):
+        if _mc_decide(net, pos[chunk], vel[chunk], length=length, steepness=steepness, stop_on_safe=True).any():
+            return True
+    return False
+
+
+# Differentiable closed-loop MC rollout of N initial states in lockstep, net is a torch module
+# Returns mc_robustness as a float64 tensor of N, with the maximum over steps smoothed by soft_max(temperature)
+def mc_simulate_torch(net: MC_Control_NN, pos_0, vel_0, length=111, steepness=0.0025, temperature=0.0):
+    pos = torch.as_tensor(np.array(pos_0, dtype=np.float64).reshape(-1))
+    vel = torch.as_tensor(np.array(vel_0, dtype=np.float64).reshape(-1))
+    traj_pos = [pos]
+    for i in range(1, length):
+        u = net(torch.stack([pos, vel], dim=-1).float()).double()[:, 0]
+        pos, vel = pos + vel, vel + 0.0015 * u - steepness * torch.cos(3 * pos)
+        # simulator constraints
+        vel = torch.clamp(vel, -0.07, 0.07)
+        pos = torch.clamp(pos, -1.2, 0.6)
+        vel = torch.where((pos == -1.2) & (vel < 0), torch.zeros_like(vel), vel)
+        traj_pos.append(pos)
+    return soft_max(torch.stack(traj_pos), temperature) - 0.45
 
-# Objective function
-def mc_energy(bad_states, net):
-    h_robustness_bad = []
-    for bad_state in bad_states:
-        traj_pos_bad, _ = mc_simulate(bad_state[0], bad_state[1], net)
-        h_robustness_bad += [mc_robustness(traj_pos_bad)]
-    return np.mean(h_robustness_bad)
 
+# Upper bounds of mc_robustness of N initial states, simulated in lockstep until their sum is below stop_below
+# Exact robustness if it never is
+def mc_simulate_bounded(net: MC_Control_NN, pos_0, vel_0, stop_below, length=111, steepness=0.0025):
+    pos = np.array(pos_0, dtype=np.float64).reshape(-1)
+    vel = np.array(vel_0, dtype=np.float64).reshape(-1)
+    return _mc_rollout(as_numpy_control_nn(net), pos, vel, length=length, steepness=steepness, stop_below=stop_below)
 
-""" Other utils """
 
+# Simulate K networks of the same architecture on the same N initial states, returns a (K, N) robustness matrix
+def mc_simulate_population(nets: list, pos_0, vel_0, length=111, steepness=0.0025):
+    stacked_net = NumpyControlNN.stack(nets)
+    shape = (stacked_net.num_networks, np.size(pos_0))
+    pos = np.broadcast_to(np.array(pos_0, dtype=np.float64).reshape(-1), shape).copy()
+    vel = np.broadcast_to(np.array(vel_0, dtype=np.float64).reshape(-1), shape).copy()
+    return _mc_rollout(stacked_net, pos, vel, length=length, steepness=steepness)
 
-# Color the regions into red, yellow, green
-# Red: counterexample sampled; yellow: no counterexample sampled, but verification fails; green: verification passes
-def color_regions(verisig_result_path, sampled_result_path):
-    df_verisig = pd.read_csv(verisig_result_path)
-    df_sample = pd.read_csv(sampled_result_path)
-
-    dict_color = {}
-    count_green = 0
-    count_yellow = 0
-    count_red = 0
-
-    for idx, row in df_verisig.iterrows():
-        verisig_result = row['result']  # safe, unknown, unsafe
-        df_region_sample = df_sample[df_sample['region'] == idx]
-        sampled_result = (df_region_sample['result'] >= 0).all()  # true if all safe, false otherwise
-        if verisig_result == 'safe' or verisig_result == 'unknown?':
-            dict_color[idx] = 'green'
-            count_green += 1
-        elif sampled_result:
-            dict_color[idx] = 'yellow'
-            count_yellow += 1
-        else:
-            dict_color[idx] = 'red'
-            count_red += 1
-    print(f'Green, green hatches, red: {count_green}, {count_yellow}, {count_red}')
-    return dict_color
 
+# Objective function
+def mc_barriered_energy(bad_states, good_states, net, lambda_=1.0, cache: RobustnessCache = ROBUSTNESS_CACHE):
+    bad_states = states_to_array(bad_states)
+    h_robustness_bad = mc_simulate_batch(net, bad_states[:, 0], bad_states[:, 1], cache=cache)
 
-# Sort a set of regions in decreasing order of average robustness
-def sort_regions(df, benchmark='uuv'):
+    good_states = states_to_array(good_states)
+    h_robustness_good = mc_simulate_batch(net, good_states[:, 0], good_states[:, 1], cache=cache)
+    log_barriers = robustness_log_barriers(h_robustness_good)
 
-    if df.empty:
-        return []
-    region_robustness = []
+    barrier = np.mean(log_barriers) if len(log_barriers) > 0 else 0.0
+    return lambda_ * np.mean(h_robustness_bad) + barrier, h_robustness_bad, h_robustness_good
 
-    if benchmark == 'uuv':
-        num_regions = 2000
-    elif benchmark == 'mc':
-        num_regions = 900
-    else:
-        raise NotImplementedError
 
-    for i in range(num_regions):
-        df_region = df[df['region'] == i]
-        if df_region.empty:
-            continue
-        avg_robustness = df_region['result'].mean()
-        region_robustness += [[i, avg_robustness]]
+# Objective function
+def mc_energy(bad_states, net, cache: RobustnessCache = ROBUSTNESS_CACHE):
+    bad_states = states_to_array(bad_states)
+    h_robustness_bad = mc_simulate_batch(net, bad_states[:, 0], bad_states[:, 1], cache=cache)
+    return np.mean(h_robustness_bad)
 
-    # Sort by robustness in decreasing order
-    region_robustness.sort(key=lambda x: x[1], reverse=True)
 
-    return region_robustness
+# mc_energy of K networks in one population simulation, returns a (K,) array
+def mc_energy_population(bad_states, nets: list):
+    bad_states = states_to_array(bad_states)
+    h_robustness_bad = mc_simulate_population(nets, bad_states[:, 0], bad_states[:, 1])
+    return np.mean(h_robustness_bad, axis=1)
 
 
-# Check robustness on sampled states
-def check_samples(repaired_net_path, sampled_result_path, sample_repaired_result_path, benchmark='uuv'):
+""" Other utils """
+
+
+# Per-region aggregates of the sampled results in one pass: sample count, all_safe, min and mean robustness
+# Regions 0 .. num_regions - 1, those without samples count as all safe with nan min and mean
+# Stale samples (nan robustness, not re-checked by an incremental check_samples) are counted in stale only,
+# the other aggregates are over the samples with robustness
+# df_sample is a DataFrame or a SampleStore of the sampled results
+def region_summary(df_sample, num_regions):
+    if isinstance(df_sample, SampleStore):
+        regions, robustness = df_sample.regions, df_sample.robustness
+    else:
+        regions = df_sample['region'].to_numpy(dtype=np.int64)
+        robustness = df_sample['result'].to_numpy(dtype=np.float64)
+    size = max(num_regions, regions.max() + 1 if len(regions) > 0 else 0)
+    stale = np.isnan(robustness)
+    num_stale = np.bincount(regions[stale], minlength=size)
+    regions, robustness = regions[~stale], robustness[~stale]
+    count = np.bincount(regions, minlength=size)
+    num_unsafe = np.bincount(regions, weights=robustness < 0, minlength=size)
+    total = np.bincount(regions, weights=robustness, minlength=size)
+    min_robustness = np.full(size, np.inf)
+    np.minimum.at(min_robustness, regions, robustness)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_robustness = total / count
+    min_robustness[count == 0] = np.nan
+    return pd.DataFrame({'count': count, 'stale': num_stale, 'all_safe': num_unsafe == 0, 'min': min_robustness,
+                         'mean': mean_robustness})[:num_regions]
+
+
+# Color the regions into red, yellow, green
+# Red: counterexample sampled; yellow: no counterexample sampled, but verification fails; green: verification passes
+# Returns the region_summary joined with the verisig result and a color column, and the counts of each color
+# sampled_result_path can also be the sampled results as a DataFrame or SampleStore, e.g. returned by check_samples
+def color_region_summary(verisig_result_path, sampled_result_path):
+    df_verisig = read_table(verisig_result_path)
+    df_sample = sampled_result_path if isinstance(sampled_result_path, (pd.DataFrame, SampleStore)) else read_table(sampled_result_path)
+
+    df_summary = region_summary(df_sample, len(df_verisig))
+    df_summary['verisig'] = df_verisig['result'].to_numpy()  # safe, unknown, unsafe
+    green = df_summary['verisig'].isin(['safe', 'unknown?']).to_numpy()
+    yellow = ~green & df_summary['all_safe'].to_numpy()
+    df_summary['color'] = np.where(green, 'green', np.where(yellow, 'yellow', 'red'))
+
+    counts = {'green': int(green.sum()), 'yellow': int(yellow.sum()), 'red': int((~green & ~yellow).sum())}
+    print(f'Green, green hatches, red: {counts["green"]}, {counts["yellow"]}, {counts["red"]}')
+    return df_summary, counts
+
+
+# Check robustness on sampled states, simulated column-wise in chunks of chunk_size states into one result array
+# The result is written once to sample_repaired_result_path, CSV or .npz (a delta against the base table if given),
+# and returned as a DataFrame with return_df
+# sampled_result_path can also be a SampleStore of the samples, the result is then returned as a SampleStore
+# With df_prev, the results of the same samples under the previous network (DataFrame or SampleStore), the check is incremental:
+# all samples of the colored_regions (regions colored by their samples, red or yellow, by default all) are simulated,
+# so that colors and the region queue means are exact
+# In the other regions, a random probe of probe_fraction of their samples, drawn from generator, is simulated first and
+# safety_factor times its largest robustness change estimates the change of the others, those with a larger margin |result|
+# are not simulated: the estimate is not a bound, so they are stale, their result is nan and the next check simulates them
+# The number of stale samples is in the attrs of the returned results
+def check_samples(repaired_net_path, sampled_result_path, sample_repaired_result_path, benchmark='uuv', cache: RobustnessCache = ROBUSTNESS_CACHE,
+                  chunk_size=4096, return_df=False, df_prev=None, probe_fraction=0.05, safety_factor=2.0, base=None,
+                  colored_regions=None, generator: np.random.Generator = None):
 
     if repaired_net_path.endswith('.yml'):
         with open(repaired_net_path, 'rb') as f:
@@ -294,36 +891,62 @@ def check_samples(repaired_net_path, sampled_result_path, sample_repaired_result
             raise NotImplementedError
         load_model_dict(model_dict, net)
     else:
-        net = torch.load(repaired_net_path)
-    df_sample = pd.read_csv(sampled_result_path)
-    print('Checking sampled states ...')
+        net = torch.load(repaired_net_path, weights_only=False)
+    net = NumpyControlNN.from_module(net)  # compiled once for all chunks
 
     if benchmark == 'uuv':
-        df_sample_repaired = pd.DataFrame(columns=['region', 'y', 'h', 'result'])
-        for idx, row in df_sample.iterrows():
-            result_dict = {}
-            region, y, h = row['region'], row['y'], row['h']
-            _, traj_pos_y = uuv_simulate(net=net, init_global_heading_deg=h, init_pos_y=y)
-            robustness = uuv_robustness(traj_pos_y)
-            result_dict['region'] = region
-            result_dict['y'] = y
-            result_dict['h'] = h
-            result_dict['result'] = robustness
-            df_sample_repaired = pd.concat([df_sample_repaired, pd.DataFrame([result_dict])], ignore_index=True)
+        state_columns = ('y', 'h')
+        simulate_batch = uuv_simulate_batch
     elif benchmark == 'mc':
-        df_sample_repaired = pd.DataFrame(columns=['region', 'pos', 'vel', 'result'])
-        for idx, row in df_sample.iterrows():
-            result_dict = {}
-            region, pos, vel = row['region'], row['pos'], row['vel']
-            traj_pos, _ = mc_simulate(pos, vel, net)
-            robustness = mc_robustness(traj_pos)
-            result_dict['region'] = region
-            result_dict[f'pos'] = pos
-            result_dict[f'vel'] = vel
-            result_dict[f'result'] = robustness
-            df_sample_repaired = pd.concat([df_sample_repaired, pd.DataFrame([result_dict])], ignore_index=True)
+        state_columns = ('pos', 'vel')
+        simulate_batch = mc_simulate_batch
     else:
         raise NotImplementedError
 
-    df_sample_repaired.to_csv(sample_repaired_result_path, index=False)
+    samples = sampled_result_path if isinstance(sampled_result_path, SampleStore) else SampleStore.read(sampled_result_path, state_columns)
+    print('Checking sampled states ...')
+
+    states = samples.states
+    robustness = np.empty(len(states))
+
+    def simulate(indices):
+        for chunk in state_chunks(len(indices), chunk_size):
+            robustness[indices[chunk]] = simulate_batch(net, states[indices[chunk], 0], states[indices[chunk], 1], cache=cache)
+
+    num_stale = 0
+    if df_prev is None:
+        simulate(np.arange(len(states)))
+    else:
+        assert len(df_prev) == len(states), 'Previous results must be of the same samples'
+        if isinstance(df_prev, SampleStore):
+            robustness_prev = df_prev.robustness
+        else:
+            robustness_prev = df_prev['result'].to_numpy(dtype=np.float64)[samples.order]  # rows to region order
+        colored = np.ones(len(states), dtype=bool) if colored_regions is None else np.isin(samples.regions, colored_regions)
+        simulate(np.flatnonzero(colored))
+
+        others = np.flatnonzero(~colored)
+        generator = np.random.default_rng() if generator is None else generator
+        num_probe = min(max(int(probe_fraction * len(others)), 1), len(others))
+        probe = np.sort(generator.choice(others, size=num_probe, replace=False))
+        simulate(probe)
+        changes = np.abs(robustness[probe] - robustness_prev[probe])
+        estimate = safety_factor * np.max(changes[~np.isnan(changes)], initial=0.0)
+        stale = ~colored & (np.abs(robustness_prev) > estimate)  # stale ones of the previous check (nan) are simulated
+        stale[probe] = False
+        robustness[stale] = np.nan
+        pending = ~colored & ~stale
+        pending[probe] = False
+        simulate(np.flatnonzero(pending))
+        num_stale = int(stale.sum())
+        print(f'Incremental check: robustness change estimate {estimate}, {num_stale} / {len(states)} samples left stale, '
+              f'{len(states) - num_stale} simulated')
+
+    samples_repaired = samples.with_robustness(robustness)
+    samples_repaired.attrs['num_stale'] = num_stale
+    samples_repaired.write(sample_repaired_result_path, base=base)
+    if isinstance(sampled_result_path, SampleStore):
+        return samples_repaired
+    if return_df:
+        return samples_repaired.to_frame()
     return
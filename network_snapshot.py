@@ -0,0 +1,225 @@
+import itertools
+from incremental_repair_utils import *
+
+
+_version_ids = itertools.count()
+
+
+# Parameter layout of a controller network: (name, shape) of each state_dict entry in order, e.g. ('fc1.weight', (32, 2))
+def control_nn_layout(network: nn.Module):
+    return tuple((name, tuple(param.shape)) for name, param in network.state_dict().items())
+
+
+# Parameters of a layout as views of flat parameters (..., num_params), by name
+def control_nn_params(layout, params):
+    views = {}
+    offset = 0
+    for name, shape in layout:
+        size = int(np.prod(shape))
+        views[name] = params[..., offset:offset + size].reshape(params.shape[:-1] + shape)
+        offset += size
+    return views
+
+
+# Weights and biases of a layout as views of flat parameters (..., num_params), in layer order
+def control_nn_weights(layout, params):
+    views = control_nn_params(layout, params)
+    weights = [view for name, view in views.items() if name.endswith('.weight')]
+    biases = [view for name, view in views.items() if name.endswith('.bias')]
+    return weights, biases
+
+
+# Immutable version of a controller network: benchmark, parameter layout and activations of the architecture,
+# read-only flat float32 parameters and a version id
+# Copies share the parameter vector, perturbing creates a new version and rolling back is keeping the old one
+class NetworkSnapshot:
+
+    def __init__(self, benchmark, params, layout, parent_version=None):
+        params = np.array(params, dtype=np.float32).reshape(-1)
+        params.flags.writeable = False
+        assert len(params) == sum(int(np.prod(shape)) for _, shape in layout), 'Parameters must match the layout'
+        self.benchmark = benchmark
+        self.layout = tuple(layout)
+        self.activations = control_nn_activations(benchmark, sum(name.endswith('.weight') for name, _ in self.layout))
+        self.params = params
+        self.version = next(_version_ids)
+        self.parent_version = parent_version
+        self._numpy_control_nn = None
+
+    # Layout from the state_dict of the module, so any layer sizes are supported
+    # With check, the compiled NumPy forward pass is checked against the module, see check_numpy_control_nn
+    @classmethod
+    def from_module(cls, network: nn.Module, check=True):
+        state_dict = network.state_dict()
+        params = np.concatenate([param.detach().numpy().reshape(-1) for param in state_dict.values()])
+        snapshot = cls(control_nn_benchmark(network), params, control_nn_layout(network))
+        if check:
+            check_numpy_control_nn(network, snapshot.numpy_control_nn())
+        return snapshot
+
+    # Layer sizes from the offsets of the model dict
+    @classmethod
+    def from_model_dict(cls, model_dict: dict, benchmark='uuv'):
+        layer_sizes = [len(model_dict['offsets'][layer]) for layer in sorted(model_dict['offsets'])][:-1]
+        if benchmark == 'uuv':
+            network = UUV_Control_NN(*layer_sizes)
+        elif benchmark == 'mc':
+            network = MC_Control_NN(*layer_sizes)
+        else:
+            raise NotImplementedError
+        load_model_dict(model_dict, network)
+        return cls.from_module(network)
+
+    # New torch module with these parameters and layer sizes, e.g. for torch.save and dump_model_dict
+    def to_module(self):
+        layer_sizes = [shape[0] for name, shape in self.layout if name.endswith('.weight')][:-1]
+        if self.benchmark == 'uuv':
+            network = UUV_Control_NN(*layer_sizes)
+        elif self.benchmark == 'mc':
+            network = MC_Control_NN(*layer_sizes)
+        else:
+            raise NotImplementedError
+        network.load_state_dict({name: torch.from_numpy(view.copy()) for name, view in control_nn_params(self.layout, self.params).items()})
+        return network
+
+    # New version with these parameters, derived from this one
+    def with_params(self, params):
+        return NetworkSnapshot(self.benchmark, params, self.layout, parent_version=self.version)
+
+    # New version with i.i.d. Gaussian noise of std on every parameter, or in a PerturbationSubspace, drawn from the torch RNG
+    def perturb(self, std, generator=None, subspace=None):
+        if subspace is None:
+            noise = torch.normal(mean=0.0, std=std, size=self.params.shape, generator=generator).numpy()
+        else:
+            noise = subspace.sample(std, generator=generator)
+        return self.with_params(self.params + noise)
+
+    # Compiled weights, built once per version
+    def numpy_control_nn(self):
+        if self._numpy_control_nn is None:
+            weights, biases = control_nn_weights(self.layout, self.params)
+            self._numpy_control_nn = NumpyControlNN(weights, biases, self.activations)
+        return self._numpy_control_nn
+
+    def fingerprint(self):
+        return self.numpy_control_nn().fingerprint()
+
+    def __call__(self, x):
+        return self.numpy_control_nn()(x)
+
+    def __len__(self):
+        return len(self.params)
+
+    # Immutable, so copies are the snapshot itself
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f'NetworkSnapshot(benchmark={self.benchmark}, num_params={len(self)}, version={self.version}, parent_version={self.parent_version})'
+
+
+# Convex combinations w * params_lo + (1 - w) * params_hi of two versions of a controller, for any architecture
+# Parameters are computed into a preallocated buffer and compiled into one NumpyControlNN updated in place,
+# so that no network is built per weight
+class ParameterInterpolation:
+
+    def __init__(self, net_lo: NetworkSnapshot, net_hi: NetworkSnapshot):
+        assert net_lo.layout == net_hi.layout and net_lo.activations == net_hi.activations, 'Interpolated versions must share the architecture'
+        self.net_hi = net_hi
+        self.params_hi = net_hi.params
+        self.delta = net_lo.params - net_hi.params
+        self.params = np.empty_like(self.params_hi)
+        self._network = None
+
+    # Flat parameters at w into out, by default the shared buffer, or (K, num_params) parameters at K weights
+    def params_at(self, w, out=None):
+        w = np.asarray(w, dtype=np.float32)
+        if out is None:
+            out = self.params if w.ndim == 0 else np.empty(w.shape + self.delta.shape, dtype=np.float32)
+        np.multiply(w[..., None], self.delta, out=out)
+        out += self.params_hi
+        return out
+
+    # Compiled network at w, the same NumpyControlNN every call, valid until the next one
+    def network_at(self, w):
+        weights, biases = control_nn_weights(self.net_hi.layout, self.params_at(w))
+        if self._network is None:
+            self._network = NumpyControlNN(weights, biases, self.net_hi.activations)
+        else:
+            self._network.load(weights, biases)
+        return self._network
+
+    # New version at w with its own copy of the parameters, e.g. the result of a search
+    def snapshot_at(self, w):
+        return self.net_hi.with_params(self.params_at(w))
+
+    def __repr__(self):
+        return f'ParameterInterpolation(num_params={len(self.params)})'
+
+
+# Subspace of the flat parameters of a layout that annealing perturbs, with the same noise std per direction
+# Either a mask of perturbed parameters (e.g. the last layer) or an orthonormal basis (num_params, rank) of a low-rank subspace
+class PerturbationSubspace:
+
+    def __init__(self, layout, mask=None, basis=None):
+        self.layout = tuple(layout)
+        self.mask = mask
+        self.basis = basis
+
+    # Perturb only the parameters of the given layers, e.g. ['fc3'] for the last layer
+    @classmethod
+    def layers(cls, layout, layer_names):
+        mask = np.concatenate([np.full(int(np.prod(shape)), name.split('.')[0] in layer_names) for name, shape in layout])
+        return cls(layout, mask=mask)
+
+    @classmethod
+    def last_layer(cls, layout):
+        return cls.layers(layout, [layout[-1][0].split('.')[0]])
+
+    # Uniformly random rank-dimensional subspace, drawn from the torch RNG
+    @classmethod
+    def random(cls, layout, rank, generator=None):
+        num_params = sum(int(np.prod(shape)) for _, shape in layout)
+        gaussian = torch.randn(num_params, rank, generator=generator, dtype=torch.float64).numpy()
+        basis, _ = np.linalg.qr(gaussian)
+        return cls(layout, basis=basis)
+
+    # Span of the rank principal directions of vectors (M, num_params), e.g. robustness gradients or parameter updates
+    # There are at most M directions, a larger rank is clipped to M with a warning
+    @classmethod
+    def pca(cls, layout, vectors, rank, center=True):
+        vectors = np.asarray(vectors, dtype=np.float64)
+        if center:
+            vectors = vectors - np.mean(vectors, axis=0)
+        _, _, vh = np.linalg.svd(vectors, full_matrices=False)
+        if rank > len(vh):
+            print(f'Warning: PCA subspace rank clipped from {rank} to {len(vh)}, the number of vectors')
+        return cls(layout, basis=vh[:rank].T)
+
+    @property
+    def dimension(self):
+        if self.basis is not None:
+            return self.basis.shape[1]
+        return int(np.count_nonzero(self.mask))
+
+    # Gaussian noise of std per subspace direction, as flat float32 parameters
+    def sample(self, std, generator=None):
+        noise = torch.normal(mean=0.0, std=std, size=(self.dimension,), generator=generator, dtype=torch.float64).numpy()
+        if self.basis is not None:
+            return (self.basis @ noise).astype(np.float32)
+        full_noise = np.zeros(len(self.mask), dtype=np.float32)
+        full_noise[self.mask] = noise
+        return full_noise
+
+    # Orthogonal projection of a flat parameter vector, e.g. a gradient, onto the subspace
+    def project(self, vector):
+        if self.basis is not None:
+            return (self.basis @ (self.basis.T @ vector)).astype(np.float32)
+        return np.where(self.mask, vector, 0.0).astype(np.float32)
+
+    def __repr__(self):
+        kind = 'basis' if self.basis is not None else 'mask'
+        return f'PerturbationSubspace({kind}, dimension={self.dimension})'
@@ -0,0 +1,112 @@
+import time
+import multiprocessing
+from network_snapshot import *
+
+
+# Worker process setup: share the already loaded UUV dynamics, one torch thread per worker
+def _init_annealing_worker(dynamics: UUVDynamics):
+    set_uuv_dynamics(dynamics)
+    torch.set_num_threads(1)
+
+
+# Process pool for the annealing chains, spawned so that workers do not inherit torch thread state
+def make_annealing_pool(num_workers=None):
+    num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+    context = multiprocessing.get_context('spawn')
+    return context.Pool(processes=num_workers, initializer=_init_annealing_worker, initargs=(get_uuv_dynamics(),))
+
+
+# Run num_iter Metropolis iterations of one chain from (params, obj_value), starting at temperature T
+# Returns the last accepted params and energy, the best accepted params and energy, and the number of accepted proposals
+def _anneal_chain_segment(args):
+    benchmark, layout, params, obj_value, bad_states, std, T, alpha, num_iter, seed = args
+    torch.manual_seed(seed)
+
+    if benchmark == 'uuv':
+        energy = uuv_energy
+    elif benchmark == 'mc':
+        energy = mc_energy
+    else:
+        raise NotImplementedError
+
+    current_net = NetworkSnapshot(benchmark, params, layout)
+    best_params, best_obj_value = current_net.params, obj_value
+    num_accepted = 0
+    for i in range(num_iter):
+        new_net = current_net.perturb(std)
+        new_obj_value = energy(bad_states, new_net, cache=None)  # the cache of a worker is never read back
+
+        # Metropolis-Hastings criterion, same as simulated_annealing
+        delta_E = new_obj_value - obj_value
+        if not (delta_E < 0.001 and torch.rand(1).item() > np.exp(delta_E / T)):
+            current_net, obj_value = new_net, new_obj_value
+            num_accepted += 1
+            if obj_value > best_obj_value:
+                best_params, best_obj_value = current_net.params, obj_value
+
+        # Cooling
+        T *= alpha
+
+    return current_net.params, obj_value, best_params, best_obj_value, num_accepted
+
+
+# Parallel tempering: num_chains annealing chains at temperatures T * temperature_ratio ** k, all cooled by alpha,
+# run swap_interval iterations at a time on a process pool, then adjacent chains swap states with the replica exchange criterion
+# Returns the best accepted version over all chains and its energy
+def parallel_tempering_annealing(region_id, net, bad_states, num_chains=4, swap_interval=20, num_workers=None, temperature_ratio=2.0,
+                                 std=0.2, T=0.1, alpha=0.95, num_iter=200, benchmark='uuv', pool=None):
+
+    start_time = time.time()
+
+    print(f'Parallel tempering on region {region_id} with {num_chains} chains ...')
+
+    if benchmark == 'uuv':
+        energy = uuv_energy
+    elif benchmark == 'mc':
+        energy = mc_energy
+    else:
+        raise NotImplementedError
+
+    own_pool = pool is None
+    if own_pool:
+        pool = make_annealing_pool(min(num_chains, multiprocessing.cpu_count()) if num_workers is None else num_workers)
+
+    net = net if isinstance(net, NetworkSnapshot) else NetworkSnapshot.from_module(net)
+    bad_states = states_to_array(bad_states)
+    obj_value = energy(bad_states, net)
+    chains = [(net.params, obj_value) for _ in range(num_chains)]
+    temperatures = [T * temperature_ratio ** k for k in range(num_chains)]
+    best_params, best_obj_value = net.params, obj_value
+    num_accepted, num_swaps, num_swap_attempts = 0, 0, 0
+
+    try:
+        for i in range(0, num_iter, swap_interval):
+            num_segment_iter = min(swap_interval, num_iter - i)
+            seeds = torch.randint(0, 2 ** 31 - 1, (num_chains,)).tolist()
+            results = pool.map(_anneal_chain_segment, [(benchmark, net.layout, params, chain_obj_value, bad_states, std, T_k, alpha, num_segment_iter, seed)
+                                                       for (params, chain_obj_value), T_k, seed in zip(chains, temperatures, seeds)])
+            chains = [(params, chain_obj_value) for params, chain_obj_value, _, _, _ in results]
+            for _, _, chain_best_params, chain_best_obj_value, chain_num_accepted in results:
+                num_accepted += chain_num_accepted
+                if chain_best_obj_value > best_obj_value:
+                    best_params, best_obj_value = chain_best_params, chain_best_obj_value
+            temperatures = [T_k * alpha ** num_segment_iter for T_k in temperatures]
+
+            # Replica exchange between adjacent temperatures, alternating even and odd pairs
+            # Energy is maximized, so chains swap with probability min(1, exp((E_j - E_i) * (1 / T_i - 1 / T_j)))
+            for k in range((i // swap_interval) % 2, num_chains - 1, 2):
+                num_swap_attempts += 1
+                log_ratio = (chains[k + 1][1] - chains[k][1]) * (1 / temperatures[k] - 1 / temperatures[k + 1])
+                if log_ratio >= 0 or torch.rand(1).item() < np.exp(log_ratio):
+                    chains[k], chains[k + 1] = chains[k + 1], chains[k]
+                    num_swaps += 1
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    print(f'Accepted proposals: {num_accepted} / {num_chains * num_iter}, swaps: {num_swaps} / {num_swap_attempts}')
+    print(f'Execution time: {time.time() - start_time}')
+
+    best_net = net.with_params(best_params) if best_params is not net.params else net
+    return best_net, best_obj_value
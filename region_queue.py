@@ -0,0 +1,62 @@
+import heapq
+import itertools
+import numpy as np
+
+
+# Priority queue of regions to be repaired, highest average robustness first (greedy order in ease of repair), ties by region id
+# A binary heap of (-avg_robustness, region_id, entry_id) with an index from region to its live entry:
+# updating or removing a region invalidates its entry in O(1) and pushes a new one in O(log n),
+# invalid entries are discarded when they reach the top, so popping is O(log n) amortized
+class RegionQueue:
+
+    def __init__(self, region_ids=(), avg_robustness=()):
+        self._index = {}  # region id -> live entry id
+        self._entry_ids = itertools.count()
+        self._heap = []
+        self.update(region_ids, avg_robustness)
+
+    # One vectorized pass over the per-region aggregates, e.g. of color_region_summary: regions with color are queued
+    @classmethod
+    def from_summary(cls, df_summary, color='red'):
+        region_ids = np.flatnonzero((df_summary['color'] == color).to_numpy())
+        return cls(region_ids, df_summary['mean'].to_numpy()[region_ids])
+
+    # Insert regions or change their average robustness, heapified at once into an empty heap
+    def update(self, region_ids, avg_robustness):
+        push = heapq.heappush if self._heap else list.append
+        for region_id, robustness in zip(np.asarray(region_ids).tolist(), np.asarray(avg_robustness).tolist()):
+            entry_id = next(self._entry_ids)
+            self._index[region_id] = entry_id
+            push(self._heap, (-robustness, region_id, entry_id))
+        if push is list.append or len(self._heap) > 2 * len(self._index) + 64:  # or mostly invalid entries, rebuild
+            self._heap = [entry for entry in self._heap if self._index.get(entry[1]) == entry[2]]
+            heapq.heapify(self._heap)
+
+    def remove(self, region_ids):
+        for region_id in np.asarray(region_ids).tolist():
+            self._index.pop(region_id, None)
+
+    def _discard_invalid(self):
+        while self._heap and self._index.get(self._heap[0][1]) != self._heap[0][2]:
+            heapq.heappop(self._heap)
+
+    # Next region and its average robustness, without removing it
+    def peek(self):
+        self._discard_invalid()
+        neg_robustness, region_id, _ = self._heap[0]
+        return region_id, -neg_robustness
+
+    def pop(self):
+        region_id, robustness = self.peek()
+        heapq.heappop(self._heap)
+        del self._index[region_id]
+        return region_id, robustness
+
+    def __contains__(self, region_id):
+        return region_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return f'RegionQueue(regions={len(self)}, heap={len(self._heap)})'
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+import numpy as np
+
+
+# Memoized STL robustness of (network, initial state) pairs, with LRU eviction beyond max_entries
+# Keys are the simulation (benchmark and its parameters, see simulation_cache_key), a fingerprint of the network parameters
+# and the exact initial state, about 250 bytes per entry
+class RobustnessCache:
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _keys(simulation, fingerprint, states):
+        return [(simulation, fingerprint, s0, s1) for s0, s1 in np.asarray(states)[:, :2].tolist()]
+
+    # Returns cached robustness of each state (nan if missing) and the mask of missing states
+    def lookup(self, simulation, fingerprint, states):
+        keys = self._keys(simulation, fingerprint, states)
+        robustness = np.full(len(keys), np.nan)
+        missing = np.ones(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                robustness[i] = value
+                missing[i] = False
+        num_missing = int(missing.sum())
+        self.hits += len(keys) - num_missing
+        self.misses += num_missing
+        return robustness, missing
+
+    def store(self, simulation, fingerprint, states, robustness):
+        for key, value in zip(self._keys(simulation, fingerprint, states), np.asarray(robustness).tolist()):
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        return f'RobustnessCache(entries={len(self)}, hits={self.hits}, misses={self.misses}, hit_rate={hit_rate:.3f})'
+
+
+# Cache shared by the energies, the IBCL search and the repair loop of this process
+ROBUSTNESS_CACHE = RobustnessCache()
@@ -5,7 +5,7 @@ from incremental_repair_utils import *
 
 def initial_sample(initial_state_regions_path, net_path, sampled_result_path, num_sampled=10, benchmark='uuv'):
     np.random.seed(42)
-    df_regions = pd.read_csv(initial_state_regions_path)
+    df_regions = read_table(initial_state_regions_path)
 
     # Load controller network to be repaired
     with open(net_path, 'rb') as f:
@@ -19,49 +19,40 @@ def initial_sample(initial_state_regions_path, net_path, sampled_result_path, nu
     load_model_dict(model_dict, net)
 
     if benchmark == 'uuv':
-        df_sample = pd.DataFrame(columns=['region', 'y', 'h', 'result'])
+        # Draw (y, h) per sample in the same order as one np.random.uniform call each
+        y_lo, y_hi = df_regions['y_lo'].values[:, None], df_regions['y_hi'].values[:, None]
+        h_lo, h_hi = df_regions['h_lo'].values[:, None], df_regions['h_hi'].values[:, None]
+        uniforms = np.random.random_sample((len(df_regions), num_sampled, 2))
 
-        for idx, row in df_regions.iterrows():
-            y_lo, y_hi, h_lo, h_hi = row['y_lo'], row['y_hi'], row['h_lo'], row['h_hi']
+        df_sample = pd.DataFrame()
+        df_sample['region'] = np.repeat(df_regions.index.values, num_sampled)
+        df_sample['y'] = (y_lo + (y_hi - y_lo) * uniforms[:, :, 0]).reshape(-1)
+        df_sample['h'] = (h_lo + (h_hi - h_lo) * uniforms[:, :, 1]).reshape(-1)
 
-            print(f'Checking on region {idx}, with {y_lo}, {h_lo} ...')
-
-            for i in range(num_sampled):
-                result_dict = {}
-                y = np.random.uniform(y_lo, y_hi)
-                h = np.random.uniform(h_lo, h_hi)
-                _, traj_pos_y = uuv_simulate(net, h, y)
-                robustness = uuv_robustness(traj_pos_y)
-                result_dict['region'] = idx
-                result_dict[f'y'] = y
-                result_dict[f'h'] = h
-                result_dict[f'result'] = robustness
-                df_sample = pd.concat([df_sample, pd.DataFrame([result_dict])], ignore_index=True)
+        print(f'Checking on {len(df_regions)} regions, {len(df_sample)} sampled states ...')
+        df_sample['result'] = uuv_simulate_batch(net, ys=df_sample['y'].values, hs=df_sample['h'].values)
 
     elif benchmark == 'mc':
-        df_sample = pd.DataFrame(columns=['region', 'pos', 'vel', 'result'])
-
-        for idx, row in df_regions.iterrows():
-            pos_lo, pos_hi, vel_lo, vel_hi = row['pos_lo'], row['pos_hi'], row['vel_lo'], row['vel_hi']
+        # Draw (pos, vel) per sample in the same order as one np.random.uniform call each
+        pos_lo, pos_hi = df_regions['pos_lo'].values[:, None], df_regions['pos_hi'].values[:, None]
+        vel_lo, vel_hi = df_regions['vel_lo'].values[:, None], df_regions['vel_hi'].values[:, None]
+        uniforms = np.random.random_sample((len(df_regions), num_sampled, 2))
 
-            print(f'Checking on region {idx}, with {pos_lo}, {vel_lo} ...')
+        df_sample = pd.DataFrame()
+        df_sample['region'] = np.repeat(df_regions.index.values, num_sampled)
+        df_sample['pos'] = (pos_lo + (pos_hi - pos_lo) * uniforms[:, :, 0]).reshape(-1)
+        df_sample['vel'] = (vel_lo + (vel_hi - vel_lo) * uniforms[:, :, 1]).reshape(-1)
 
-            for i in range(num_sampled):
-                result_dict = {}
-                pos = np.random.uniform(pos_lo, pos_hi)
-                vel = np.random.uniform(vel_lo, vel_hi)
-                traj_pos, _ = mc_simulate(pos, vel, net)
-                robustness = mc_robustness(traj_pos)
-                result_dict['region'] = idx
-                result_dict[f'pos'] = pos
-                result_dict[f'vel'] = vel
-                result_dict[f'result'] = robustness
-                df_sample = pd.concat([df_sample, pd.DataFrame([result_dict])], ignore_index=True)
+        print(f'Checking on {len(df_regions)} regions, {len(df_sample)} sampled states ...')
+        df_sample['result'] = mc_simulate_batch(net, df_sample['pos'].values, df_sample['vel'].values)
 
     else:
         raise NotImplementedError
 
-    df_sample.to_csv(sampled_result_path)
+    if sampled_result_path.endswith('.npz'):
+        write_table(df_sample, sampled_result_path)
+    else:
+        df_sample.to_csv(sampled_result_path)
 
     return
 
@@ -71,7 +62,7 @@ if __name__ == '__main__':
     parser.add_argument("--benchmark", help="uuv or mc", default="uuv")
     parser.add_argument("--network", help="network yml file to be repaired", default=os.path.join('controllers', 'uuv_tanh_2_15_2x32_broken.yml'))
     parser.add_argument("--initial_state_regions_path", help="path to initial state regions csv", default='uuv_initial_state_regions.csv')
-    parser.add_argument("--sampled_result_path", help="path to sampling result csv", default='uuv_sampling_result.csv')
+    parser.add_argument("--sampled_result_path", help="path to sampling result, csv or npz", default='uuv_sampling_result.csv')
     parser.add_argument("--num_samples_per_region", help="number of sampled states in a region", default=10)
     args = parser.parse_args()
 
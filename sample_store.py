@@ -0,0 +1,124 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+# Tables (sample results, Verisig results, state regions) are CSV or binary columnar .npz files, by extension
+# An .npz table holds one array per column in column order, text columns as fixed-width unicode
+# An .npz table written with a base is a delta of its result column against the base table, only storing
+# the path of the base, result - base result and the few results that do not round-trip exactly through the delta
+def write_table(df, path, base=None):
+    if not path.endswith('.npz'):
+        df.to_csv(path, index=False)
+        return
+    if base is None:
+        np.savez_compressed(path, **{column: _column_array(df[column]) for column in df.columns})
+        return
+    base_result = read_table(base)['result'].to_numpy(dtype=np.float64)
+    result = df['result'].to_numpy(dtype=np.float64)
+    assert len(base_result) == len(result), 'A delta table must have the rows of its base'
+    delta = result - base_result
+    inexact = np.flatnonzero((base_result + delta != result) & ~np.isnan(result))
+    np.savez_compressed(path, __base__=np.array(os.path.relpath(base, os.path.dirname(os.path.abspath(path)))), __delta__=delta,
+                        __exact_index__=inexact, __exact_value__=result[inexact])
+
+
+def _column_array(column):
+    array = column.to_numpy()
+    return array.astype(str) if array.dtype == object or pd.api.types.is_string_dtype(column.dtype) else array
+
+
+def read_table(path):
+    if not path.endswith('.npz'):
+        return pd.read_csv(path)
+    with np.load(path) as npz:
+        if '__base__' not in npz.files:
+            return pd.DataFrame({column: npz[column] for column in npz.files})
+        df = read_table(os.path.join(os.path.dirname(os.path.abspath(path)), str(npz['__base__'])))
+        result = df['result'].to_numpy(dtype=np.float64) + npz['__delta__']
+        result[npz['__exact_index__']] = npz['__exact_value__']
+        df['result'] = result
+        return df
+
+
+# Sampled states and their robustness in CSR layout: contiguous arrays sorted by region, with offsets[r]:offsets[r + 1] the
+# samples of region r, so that any region or set of regions is sliced without scanning the samples
+# order maps the sorted samples back to the rows of the table they were read from, which is the order they are written in
+# attrs holds metadata of a result, like the DataFrame attrs, e.g. the samples kept by an incremental check_samples
+class SampleStore:
+
+    def __init__(self, states, robustness, regions, state_columns=('y', 'h'), num_regions=None):
+        regions = np.asarray(regions, dtype=np.int64).reshape(-1)
+        sort = np.argsort(regions, kind='stable')  # samples of a region keep their row order
+        self.states = np.ascontiguousarray(np.asarray(states, dtype=np.float64).reshape(-1, 2)[sort])
+        self.robustness = np.ascontiguousarray(np.asarray(robustness, dtype=np.float64).reshape(-1)[sort])
+        self.regions = regions[sort]
+        self.order = sort
+        self.state_columns = tuple(state_columns)
+        if num_regions is None:
+            num_regions = int(regions.max()) + 1 if len(regions) > 0 else 0
+        self.offsets = np.zeros(num_regions + 1, dtype=np.int64)
+        np.cumsum(np.bincount(regions, minlength=num_regions)[:num_regions], out=self.offsets[1:])
+        self.attrs = {}
+
+    @classmethod
+    def from_frame(cls, df, state_columns=('y', 'h'), num_regions=None):
+        return cls(df[list(state_columns)].to_numpy(dtype=np.float64), df['result'].to_numpy(dtype=np.float64),
+                   df['region'].to_numpy(dtype=np.int64), state_columns=state_columns, num_regions=num_regions)
+
+    # CSV or .npz table, by default with the state columns of UUV (y, h) or MC (pos, vel), whichever it has
+    @classmethod
+    def read(cls, path, state_columns=None, num_regions=None):
+        df = read_table(path)
+        if state_columns is None:
+            state_columns = ('y', 'h') if 'y' in df.columns else ('pos', 'vel')
+        return cls.from_frame(df, state_columns=state_columns, num_regions=num_regions)
+
+    # Columns region, state columns and result, in the row order of the source
+    def to_frame(self):
+        rows = np.argsort(self.order)
+        df = pd.DataFrame({'region': self.regions[rows], self.state_columns[0]: self.states[rows, 0],
+                           self.state_columns[1]: self.states[rows, 1], 'result': self.robustness[rows]})
+        df.attrs.update(self.attrs)
+        return df
+
+    # CSV or .npz table by extension, an .npz as a delta against base if given, see write_table
+    def write(self, path, base=None):
+        write_table(self.to_frame(), path, base=base)
+
+    # Same samples with new robustness (sorted like the store), the arrays other than robustness are shared
+    def with_robustness(self, robustness):
+        store = SampleStore.__new__(SampleStore)
+        store.__dict__.update(self.__dict__)
+        store.robustness = np.asarray(robustness, dtype=np.float64).reshape(-1)
+        store.attrs = {}
+        assert len(store.robustness) == len(self), 'One robustness per sample'
+        return store
+
+    @property
+    def num_regions(self):
+        return len(self.offsets) - 1
+
+    def region_slice(self, region_id):
+        return slice(self.offsets[region_id], self.offsets[region_id + 1])
+
+    def region_states(self, region_id):
+        return self.states[self.region_slice(region_id)]
+
+    def region_robustness(self, region_id):
+        return self.robustness[self.region_slice(region_id)]
+
+    # Sample indices of the given regions, e.g. of a color class, at most head per region
+    def indices(self, region_ids, head=None):
+        region_ids = np.asarray(region_ids, dtype=np.int64).reshape(-1)
+        starts = self.offsets[region_ids]
+        counts = self.offsets[region_ids + 1] - starts
+        if head is not None:
+            counts = np.minimum(counts, head)
+        return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    def __len__(self):
+        return len(self.robustness)
+
+    def __repr__(self):
+        return f'SampleStore(samples={len(self)}, regions={self.num_regions}, columns={self.state_columns})'
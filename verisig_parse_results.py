@@ -5,6 +5,7 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import argparse
+from sample_store import read_table, write_table
 
 
 def parse(output_dir, x1, x2, benchmark='uuv'):
@@ -99,14 +100,14 @@ if __name__ == '__main__':
     parser.add_argument("--benchmark", help="uuv or mc", default="uuv")
     parser.add_argument("--network", help="network yml file to be verified", default=os.path.join('controllers', 'uuv_tanh_2_15_2x32_broken.yml'))
     parser.add_argument("--verisig_output_path", help="path to output txt files of verisig", default=os.path.join('verisig', 'uuv_output'))
-    parser.add_argument("--verisig_parsed_csv", help="path to final csv", default='uuv_verisig_result.csv')
+    parser.add_argument("--verisig_parsed_csv", help="path to final csv or npz", default='uuv_verisig_result.csv')
     parser.add_argument("--initial_state_regions_csv", help="initial state regions csv from previous step", default="uuv_initial_state_regions.csv")
     args = parser.parse_args()
 
     controller_name = args.network.split('/')[-1][:-4]
 
     # Load initial state regions
-    df_initial_state_regions = pd.read_csv(args.initial_state_regions_csv)
+    df_initial_state_regions = read_table(args.initial_state_regions_csv)
     initial_state_regions = df_initial_state_regions.values.tolist()
 
     output_dir = args.verisig_output_path
@@ -120,7 +121,7 @@ if __name__ == '__main__':
                 continue
             dict_row = {'y_lo': region[0], 'y_hi': region[1], 'h_lo': region[2], 'h_hi': region[3], 'result': dict_result['result']}
             df_result = pd.concat([df_result, pd.DataFrame([dict_row])], ignore_index=True)
-        df_result.to_csv(args.verisig_parsed_csv, index=False)
+        write_table(df_result, args.verisig_parsed_csv)
 
     elif args.benchmark == 'mc':
         df_result = pd.DataFrame(columns=['pos_lo', 'pos_hi', 'vel_lo', 'vel_hi', 'result'])
@@ -131,7 +132,7 @@ if __name__ == '__main__':
                 continue
             dict_row = {'pos_lo': region[0], 'pos_hi': region[1], 'vel_lo': region[2], 'vel_hi': region[3], 'result': dict_result['result']}
             df_result = pd.concat([df_result, pd.DataFrame([dict_row])], ignore_index=True)
-        df_result.to_csv(args.verisig_parsed_csv, index=False)
+        write_table(df_result, args.verisig_parsed_csv)
 
     else:
         raise NotImplementedError
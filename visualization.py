@@ -6,7 +6,7 @@ from incremental_repair_utils import *
 
 def uuv_plot_colors(verisig_result_path, dict_color, title='UUV Result', small=False):
 
-    df_verisig = pd.read_csv(verisig_result_path)
+    df_verisig = read_table(verisig_result_path)
     fig, ax = plt.subplots()
 
     for idx, row in df_verisig.iterrows():
@@ -28,13 +28,13 @@ def uuv_plot_colors(verisig_result_path, dict_color, title='UUV Result', small=F
     ax.set_title(title)
     plt.tight_layout()
     plt.show()
-    plt.savefig(verisig_result_path.replace('.csv', '.png'))
+    plt.savefig(os.path.splitext(verisig_result_path)[0] + '.png')
     return
 
 
 def mc_plot_colors(verisig_result_path, dict_color, title='MC Result', small=False):
 
-    df_verisig = pd.read_csv(verisig_result_path)
+    df_verisig = read_table(verisig_result_path)
     fig, ax = plt.subplots()
 
     for idx, row in df_verisig.iterrows():
@@ -56,35 +56,33 @@ def mc_plot_colors(verisig_result_path, dict_color, title='MC Result', small=Fal
     ax.set_title(title)
     plt.tight_layout()
     plt.show()
-    plt.savefig(verisig_result_path.replace('.csv', '.png'))
+    plt.savefig(os.path.splitext(verisig_result_path)[0] + '.png')
     return
 
 
-def check_min_robustness(sampled_result_path, dict_color):
+# Mean and std over samples of the min robustness of their region, from the aggregates of color_region_summary
+# Stale samples (nan robustness, left by an incremental check) have no robustness and are left out, their count is reported
+def check_min_robustness(df_summary):
 
-    def check_red(region_id):
-        return dict_color[region_id] == 'red'
+    def sample_min_robustness(region_mask):
+        return pd.Series(np.repeat(df_summary['min'].to_numpy()[region_mask], df_summary['count'].to_numpy()[region_mask]))
 
-    def check_not_red(region_id):
-        return dict_color[region_id] == 'yellow' or dict_color[region_id] == 'green'
-
-    df_sample = pd.read_csv(sampled_result_path)
-    red_mask = df_sample['region'].apply(check_red)
-    df_red = df_sample[red_mask]
-    not_red_mask = df_sample['region'].apply(check_not_red)
-    df_not_red= df_sample[not_red_mask]
+    red_mask = (df_summary['color'] == 'red').to_numpy()
 
     print("Evaluating regions ... Notice that an empty set of regions will have nan mean and std. E.g. if all red regions are repaired, their mean and std will be nan.")
 
-    # Aggregate by min on robustness, group by region
-    df_red_min = df_red.join(df_red.groupby('region')['result'].agg(['min']), on='region')
-    print(f'Min robustness of all red regions have mean: {df_red_min["min"].mean()}, std: {df_red_min["min"].std()}')
+    num_stale = int(df_summary['stale'].sum())
+    if num_stale > 0:
+        print(f'Warning: {num_stale} stale samples without robustness are left out, use a full check such as sample_checkpoint_final')
+
+    red_min = sample_min_robustness(red_mask)
+    print(f'Min robustness of all red regions have mean: {red_min.mean()}, std: {red_min.std()}')
 
-    df_not_red_min = df_not_red.join(df_not_red.groupby('region')['result'].agg(['min']), on='region')
-    print(f'Min robustness of all non-red regions have mean: {df_not_red_min["min"].mean()}, std: {df_not_red_min["min"].std()}')
+    not_red_min = sample_min_robustness(~red_mask)
+    print(f'Min robustness of all non-red regions have mean: {not_red_min.mean()}, std: {not_red_min.std()}')
 
-    df_overall_min = df_sample.join(df_sample.groupby('region')['result'].agg(['min']), on='region')
-    print(f'Min robustness overall have mean: {df_overall_min["min"].mean()}, std: {df_overall_min["min"].std()}')
+    overall_min = sample_min_robustness(np.ones(len(df_summary), dtype=bool))
+    print(f'Min robustness overall have mean: {overall_min.mean()}, std: {overall_min.std()}')
 
     return
 
@@ -104,14 +102,15 @@ def str2bool(value):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--benchmark", help="uuv or mc", default="uuv")
-    parser.add_argument("--verisig_result_path", help="path to verisig result csv", default='uuv_verisig_result.csv')
-    parser.add_argument("--sampled_result_path", help="path to sampling result csv", default='uuv_sampling_result.csv')
+    parser.add_argument("--verisig_result_path", help="path to verisig result, csv or npz", default='uuv_verisig_result.csv')
+    parser.add_argument("--sampled_result_path", help="path to sampling result, csv or npz", default='uuv_sampling_result.csv')
     parser.add_argument("--small", help="if small for smoke test", default="false")
     args = parser.parse_args()
 
-    dict_color = color_regions(args.verisig_result_path, args.sampled_result_path)
+    df_summary, _ = color_region_summary(args.verisig_result_path, args.sampled_result_path)
+    dict_color = dict(enumerate(df_summary['color'].tolist()))
 
-    check_min_robustness(args.sampled_result_path, dict_color)
+    check_min_robustness(df_summary)
 
     if args.benchmark == 'uuv':
         uuv_plot_colors(args.verisig_result_path, dict_color, small=str2bool(args.small))